@@ -3,19 +3,23 @@ import os
 import sys
 import shutil
 from io import BytesIO
-import zipfile
+import types
 import logging
 import json
 import ast
+import functools
+import threading
+import time
 import operator as op
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 import gspread
 from google.oauth2.service_account import Credentials
 
 from openpyxl import Workbook
-from openpyxl.drawing.image import Image as XLImage
+from openpyxl.utils import get_column_letter
 
 # =========================
 # КОНСТАНТЫ / НАСТРОЙКИ
@@ -71,10 +75,8 @@ COMPANY_SITE = "www.axis.kz"
 def normalize_key(k):
     if k is None:
         return None
-    s = str(k)
-    s = s.replace("\xa0", " ")
-    s = " ".join(s.split())
-    return s.strip().lower()
+    # split() без аргументов уже режет по \xa0 и обрезает края
+    return " ".join(str(k).split()).lower()
 
 def _clean_cell_val(v):
     if v is None:
@@ -84,6 +86,12 @@ def _clean_cell_val(v):
     return s
 
 def safe_float(value, default=0.0):
+    # Числа (из session_state, контекстов формул) — без разбора строки; bool сюда не попадает
+    t = type(value)
+    if t is float:
+        return value
+    if t is int:
+        return float(value)
     try:
         if value is None:
             return default
@@ -95,7 +103,12 @@ def safe_float(value, default=0.0):
         return default
 
 def safe_int(value, default=0):
+    t = type(value)
     try:
+        if t is int:
+            return value
+        if t is float:
+            return int(value)
         if value is None:
             return default
         s = str(value).replace("\xa0", "").replace(" ", "").replace(",", ".")
@@ -105,14 +118,51 @@ def safe_int(value, default=0):
     except Exception:
         return default
 
+def safe_float_column(values: list, default=0.0) -> list:
+    # safe_float сразу для целого столбца. Строки чистятся так же, как в safe_float;
+    # pd.to_numeric только отбирает обычные числа, а разбирает их float() (приведение
+    # object -> float64): округление у pandas своё и на длинных дробях расходится.
+    # Остальное ("nan", "1_000", пустые, не числа) — поэлементно через safe_float
+    raw = pd.Series(values, dtype=object)
+    text = (raw.astype(str)
+               .str.replace("\xa0", "", regex=False)
+               .str.replace(" ", "", regex=False)
+               .str.replace(",", ".", regex=False))
+    plain = pd.to_numeric(text, errors="coerce").notna().to_numpy()
+    out = np.empty(len(raw), dtype=np.float64)
+    try:
+        out[plain] = text.to_numpy(dtype=object)[plain].astype(np.float64)
+    except (TypeError, ValueError):
+        plain[:] = False
+    rest = np.flatnonzero(~plain)
+    out[rest] = [safe_float(values[i], default) for i in rest]
+    return out.tolist()
+
+# Строки одного листа имеют одинаковые заголовки, поэтому нечёткий поиск
+# ключа по подстроке выполняется один раз на пару (заголовки, needle)
+@functools.lru_cache(maxsize=1024)
+def _resolve_field_key(keys: tuple, needle: str):
+    needle = (needle or "").lower().strip()
+    for k in keys:
+        if k and needle in str(k).lower():
+            return k
+    return None
+
 def get_field(row: dict, needle: str, default=None):
     if not isinstance(row, dict):
         return default
-    needle = (needle or "").lower().strip()
-    for k, v in row.items():
-        if k and needle in str(k).lower():
-            return v
-    return default
+    key = _resolve_field_key(tuple(row), needle)
+    if key is None:
+        return default
+    return row[key]
+
+def field_getter(records: list, needle: str, default=None):
+    # То же, что get_field, но ключ ищется один раз по заголовкам листа —
+    # для циклов по всем строкам справочника
+    key = _resolve_field_key(tuple(records[0]), needle) if records else None
+    if key is None:
+        return lambda row: default
+    return op.itemgetter(key)
 
 # =========================
 # БЕЗОПАСНЫЙ EVAL (ФОРМУЛЫ)
@@ -126,6 +176,8 @@ _allowed_ops = {
     ast.And: lambda a,b: a and b, ast.Or:  lambda a,b: a or b,
 }
 
+_FORMULA_FUNCS = {"min": min, "max": max}
+
 def _eval_ast(node, names):
     if isinstance(node, ast.Expression):
         return _eval_ast(node.body, names)
@@ -157,9 +209,9 @@ def _eval_ast(node, names):
                 args = [_eval_ast(a, names) for a in node.args]
                 return getattr(math, fname)(*args)
 
-        if isinstance(func, ast.Name) and func.id in ("min", "max"):
+        if isinstance(func, ast.Name) and func.id in _FORMULA_FUNCS:
             args = [_eval_ast(a, names) for a in node.args]
-            return globals()[func.id](*args)
+            return _FORMULA_FUNCS[func.id](*args)
 
     if isinstance(node, ast.Compare):
         if len(node.ops) != 1:
@@ -171,30 +223,155 @@ def _eval_ast(node, names):
 
     raise ValueError(f"Недопустимый элемент формулы: {type(node).__name__}")
 
-def safe_eval_formula(formula: str, context: dict) -> float:
-    formula = (formula or "").strip()
+_FORMULA_GLOBALS = {"__builtins__": {}, "math": math, **_FORMULA_FUNCS}
+
+def _is_compilable(node):
+    # Повторяет белый список _eval_ast: только такие деревья можно отдать в compile()
+    if isinstance(node, ast.Expression):
+        return _is_compilable(node.body)
+    if isinstance(node, ast.Constant):
+        return True
+    if isinstance(node, ast.UnaryOp):
+        return type(node.op) in _allowed_ops and _is_compilable(node.operand)
+    if isinstance(node, ast.BinOp):
+        return type(node.op) in _allowed_ops and _is_compilable(node.left) and _is_compilable(node.right)
+    if isinstance(node, ast.Compare):
+        return (len(node.ops) == 1 and type(node.ops[0]) in _allowed_ops
+                and _is_compilable(node.left) and _is_compilable(node.comparators[0]))
+    if isinstance(node, ast.Name):
+        return node.id != "math" and node.id not in _FORMULA_FUNCS and not node.id.startswith("_")
+    if isinstance(node, ast.Call):
+        func = node.func
+        if node.keywords:
+            return False
+        if isinstance(func, ast.Name):
+            ok = func.id in _FORMULA_FUNCS
+        elif isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == "math":
+            ok = not func.attr.startswith("_") and callable(getattr(math, func.attr, None))
+        else:
+            ok = False
+        return ok and all(_is_compilable(a) for a in node.args)
+    return False
+
+@functools.lru_cache(maxsize=4096)
+def _compile_formula(formula: str):
+    # Формулы справочников одни и те же для всех секций — разбираем каждую один раз
+    # и, если дерево проходит белый список, компилируем в байткод
+    formula = (formula or "").replace('\xa0', ' ').strip()
     if not formula:
-        return 0.0
+        return None
+    tree = ast.parse(formula, mode="eval")
+    if _is_compilable(tree):
+        return compile(tree, "<formula>", "eval")
+    return tree
 
-    formula = formula.replace('\xa0', ' ')
+def compile_formula(formula: str):
+    try:
+        return _compile_formula(formula)
+    except Exception:
+        logger.exception("Ошибка вычисления формулы: %s", formula)
+        return None
 
-    names = {
-        **context,
-        "math": math,
-        "min": min,
-        "max": max,
-    }
+def prepare_formula_context(context: dict) -> dict:
+    # Приводим значения к числам один раз — готовый контекст годится для всех формул
+    return {k: v if isinstance(v, (int, float)) else safe_float(v, 0.0) for k, v in context.items()}
+
+def eval_compiled_formula(compiled, context: dict, formula: str = "", prepared: bool = False) -> float:
+    if compiled is None:
+        return 0.0
 
     try:
-        safe_context = {k: safe_float(v, 0.0) if not isinstance(v, (int, float)) else v for k, v in names.items()}
-        
-        node = ast.parse(formula, mode="eval")
-        result = _eval_ast(node, safe_context)
+        safe_context = context if prepared else prepare_formula_context(context)
+        if isinstance(compiled, ast.AST):
+            result = _eval_ast(compiled, safe_context)
+        else:
+            result = eval(compiled, _FORMULA_GLOBALS, safe_context)
         return float(result)
     except Exception:
         logger.exception("Ошибка вычисления формулы: %s", formula)
         return 0.0
 
+def safe_eval_formula(formula: str, context: dict) -> float:
+    return eval_compiled_formula(compile_formula(formula), context, formula)
+
+# Векторный вариант: та же формула считается сразу по массивам всех секций.
+# Функции math — только одноаргументные обёртки, чтобы numpy не принял второй аргумент за out=
+def _np_unary(fn):
+    return lambda x: fn(x)
+
+def _np_reduce(fn):
+    def _call(*args):
+        if len(args) < 2:
+            raise TypeError("ожидается минимум два аргумента")
+        return functools.reduce(fn, args)
+    return _call
+
+_NP_MATH = types.SimpleNamespace(**{
+    name: _np_unary(getattr(np, name))
+    for name in ("ceil", "floor", "trunc", "sqrt", "fabs", "exp", "log", "log10", "log2",
+                 "sin", "cos", "tan", "radians", "degrees")
+})
+_NP_FORMULA_GLOBALS = {
+    "__builtins__": {},
+    "math": _NP_MATH,
+    "min": _np_reduce(np.minimum),
+    "max": _np_reduce(np.maximum),
+    "_as_float": lambda x: np.asarray(x, dtype=np.float64),
+}
+
+class _FloatCompares(ast.NodeTransformer):
+    # В Python True + True == 2, а для bool-массивов numpy это логическое ИЛИ
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        call = ast.Call(func=ast.Name(id="_as_float", ctx=ast.Load()), args=[node], keywords=[])
+        return ast.copy_location(call, node)
+
+@functools.lru_cache(maxsize=4096)
+def _compile_vector_formula(formula: str):
+    formula = (formula or "").replace('\xa0', ' ').strip()
+    if not formula:
+        return None
+    tree = ast.parse(formula, mode="eval")
+    if not _is_compilable(tree):
+        return None
+    tree = ast.fix_missing_locations(_FloatCompares().visit(tree))
+    return compile(tree, "<formula>", "eval")
+
+def _stack_contexts(contexts: list):
+    if not contexts:
+        return None
+    try:
+        return {k: np.array([ctx[k] for ctx in contexts], dtype=np.float64) for k in contexts[0]}
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def _section_totals(contexts: list, arrays: dict):
+    # Общие площадь и периметр с учётом количества (Nwin)
+    # fsum на обоих путях: итог не зависит от порядка сложения секций
+    if arrays is None:
+        return (math.fsum(ctx["area"] * ctx["qty"] for ctx in contexts),
+                math.fsum(ctx["perimeter"] * ctx["qty"] for ctx in contexts))
+    qty = arrays["qty"]
+    return math.fsum((arrays["area"] * qty).tolist()), math.fsum((arrays["perimeter"] * qty).tolist())
+
+def eval_formula_vectorized(formula: str, arrays: dict):
+    # Возвращает sum(formula(ctx) * qty) по всем секциям или None, если формулу нужно
+    # посчитать построчно (нет векторной версии, ошибка, деление на ноль и т.п.)
+    try:
+        code = _compile_vector_formula(formula)
+        if code is None:
+            return None
+        qty = arrays["qty"]
+        with np.errstate(all="ignore"):
+            values = np.asarray(eval(code, _NP_FORMULA_GLOBALS, arrays), dtype=np.float64)
+            totals = np.broadcast_to(values, qty.shape) * qty
+        if not np.isfinite(totals).all():
+            return None
+        # fsum — как и построчный путь: итог не зависит от порядка сложения секций
+        return math.fsum(totals.tolist())
+    except Exception:
+        return None
+
 # =========================
 # GOOGLE SHEETS CLIENT (АВТОРИЗАЦИЯ ЧЕРЕЗ ENV)
 # =========================
@@ -204,6 +381,16 @@ class GoogleSheetsClient:
     def __init__(self, sheet_id: str):
         self.sheet_id = sheet_id
         self._worksheets_cache = {}
+        self._records_cache = {}
+        self._numeric_cache = {}
+        self._groups_cache = {}
+        self._pending_headers = {}
+        # Клиент общий для всех сессий (get_sheets_client): кеши меняем только под замком,
+        # а запись в ЗАПРОСЫ ведём по одной, чтобы заголовок ушёл ровно один раз
+        self._lock = threading.RLock()
+        self._form_lock = threading.Lock()
+        # Версия справочников: справочники живут вместе с клиентом, новый клиент — новая версия
+        self.data_version = time.time_ns()
         self.load()
 
     @st.cache_resource
@@ -241,35 +428,52 @@ class GoogleSheetsClient:
             st.stop()
 
 
+    # Открытие таблицы — отдельный запрос к API; держим дескриптор между перезапусками
+    @st.cache_resource(show_spinner=False)
+    def _open_spreadsheet(_self, sheet_id: str):
+        client = _self._auth_v3()
+        return client.open_by_key(sheet_id)
+
     def load(self):
-        try:
-            client = self._auth_v3() 
-            self.wb = client.open_by_key(self.sheet_id)
-            logger.info("Успешно подключен к Google Sheets.")
-        except Exception as e:
-            st.error(f"Критическая ошибка при подключении к Google Sheets. Проблема с ID таблицы или с авторизацией. {e}")
-            st.stop()
+        # Ошибку не показываем здесь: клиент создаётся внутри кешируемой фабрики,
+        # сообщение и st.stop — в get_sheets_client, чтобы сбой не попал в кеш
+        self.wb = self._open_spreadsheet(self.sheet_id)
+        logger.info("Успешно подключен к Google Sheets.")
             
     def ws(self, name: str):
-        if name in self._worksheets_cache:
-            return self._worksheets_cache[name]
-        try:
-            ws = self.wb.worksheet(name)
-            self._worksheets_cache[name] = ws
-            return ws
-        except gspread.WorksheetNotFound:
-            if name == SHEET_FORM:
-                ws = self.wb.add_worksheet(name, rows="100", cols="30")
+        # Под замком целиком: две сессии не должны одновременно создавать лист ЗАПРОСЫ
+        with self._lock:
+            if name in self._worksheets_cache:
+                return self._worksheets_cache[name]
+            try:
+                ws = self.wb.worksheet(name)
                 self._worksheets_cache[name] = ws
-                ws.append_row(FORM_HEADER)
                 return ws
-            
-            st.error(f"Лист '{name}' не найден в Google Sheets. Проверьте название листа в таблице.")
-            st.stop()
+            except gspread.WorksheetNotFound:
+                if name == SHEET_FORM:
+                    ws = self.wb.add_worksheet(name, rows="100", cols="30")
+                    self._worksheets_cache[name] = ws
+                    # Заголовок допишем вместе с первой пачкой строк, без отдельного запроса
+                    self._pending_headers[name] = FORM_HEADER
+                    return ws
+
+        st.error(f"Лист '{name}' не найден в Google Sheets. Проверьте название листа в таблице.")
+        st.stop()
+
+    def read_records(self, sheet_name: str):
+        # Записи листа держим на экземпляре: клиент живёт между перезапусками
+        # (get_sheets_client), поэтому это и кеш между расчётами, и кеш внутри расчёта
+        with self._lock:
+            records = self._records_cache.get(sheet_name)
+        if records is None:
+            # Запрос к API идёт без замка; если другая сессия успела раньше — берём её записи
+            records = self._fetch_records(sheet_name)
+            with self._lock:
+                records = self._records_cache.setdefault(sheet_name, records)
+        return records
 
-    @st.cache_data(ttl=3600)
-    def read_records(_self, sheet_name: str):
-        ws = _self.ws(sheet_name)
+    def _fetch_records(self, sheet_name: str):
+        ws = self.ws(sheet_name)
         rows = ws.get_all_values()
         
         if not rows:
@@ -291,33 +495,93 @@ class GoogleSheetsClient:
                 used[key] = 1
             header.append(key)
 
+        # Форма строки задана заголовком: пары (индекс, ключ) считаем один раз,
+        # а короткие строки добиваем None до ширины заголовка
+        columns = [(i, k) for i, k in enumerate(header) if k is not None]
+        width = len(header)
+
         records = []
         for r in rows[1:]:
-            if all(v is None or v == "" for v in r):
+            # Значения gspread — строки, поэтому пустая строка = все ячейки ложны
+            if not any(r):
                 continue
-            row = {}
-            for i, k in enumerate(header):
-                if k is None:
-                    continue
-                if i < len(r):
-                    row[k] = r[i]
-                else:
-                    row[k] = None
-            records.append(row)
+            if len(r) < width:
+                r = r + [None] * (width - len(r))
+            records.append({k: r[i] for i, k in columns})
         return records
 
+    def read_numeric_column(self, sheet_name: str, needle: str, default=0.0):
+        # Числовой столбец справочника, приведённый разом и выровненный с read_records
+        key = (sheet_name, needle, default)
+        with self._lock:
+            column = self._numeric_cache.get(key)
+        if column is None:
+            records = self.read_records(sheet_name)
+            column = safe_float_column([get_field(r, needle, default) for r in records], default)
+            with self._lock:
+                column = self._numeric_cache.setdefault(key, column)
+        return column
+
+    def read_row_groups(self, sheet_name: str, needles: tuple):
+        # Номера строк (по порядку) по значениям столбцов needles без регистра.
+        # Пустая ячейка хранится как None — «подходит для любого»
+        key = (sheet_name, needles)
+        with self._lock:
+            groups = self._groups_cache.get(key)
+        if groups is None:
+            records = self.read_records(sheet_name)
+            getters = [field_getter(records, n, "") for n in needles]
+            groups = {}
+            for i, row in enumerate(records):
+                group = tuple(str(v).strip().lower() if v else None for v in (g(row) for g in getters))
+                groups.setdefault(group, []).append(i)
+            with self._lock:
+                groups = self._groups_cache.setdefault(key, groups)
+        return groups
+
     def clear_and_write(self, sheet_name: str, header: list, rows: list):
-        pass
+        with self._lock:
+            self._records_cache.pop(sheet_name, None)
+            for cache in (self._numeric_cache, self._groups_cache):
+                for key in [k for k in list(cache) if k[0] == sheet_name]:
+                    cache.pop(key, None)
 
     def append_form_row(self, row: list):
+        self.append_form_rows([row])
+
+    def append_form_rows(self, rows: list):
+        # Все строки заказа уходят одним запросом append_rows, а не запросом на каждую позицию
+        if not rows:
+            return
         try:
             ws = self.ws(SHEET_FORM)
-            ws.append_row(row, value_input_option='USER_ENTERED')
-            logger.info("Строка успешно добавлена в лист ЗАПРОСЫ.")
+            with self._form_lock:
+                # Заголовок снимаем только после успешной записи — при ошибке API он уйдёт со следующей пачкой
+                with self._lock:
+                    header = self._pending_headers.get(SHEET_FORM)
+                ws.append_rows([header] + rows if header else rows, value_input_option='USER_ENTERED')
+                with self._lock:
+                    self._pending_headers.pop(SHEET_FORM, None)
+                    self._records_cache.pop(SHEET_FORM, None)
+            logger.info("Строки (%d) успешно добавлены в лист ЗАПРОСЫ.", len(rows))
         except Exception as e:
             logger.error("Ошибка при записи в лист ЗАПРОСЫ: %s", e)
             st.error(f"Ошибка при записи в Google Sheets: {e}")
 
+# Один клиент на процесс: таблица, листы и прочитанные справочники переживают
+# перезапуски скрипта. ttl ограничивает возраст данных тем же часом, что и раньше.
+# Исключение из фабрики не кешируется — после сбоя следующий перезапуск подключится заново
+@st.cache_resource(ttl=3600, show_spinner=False)
+def _shared_sheets_client(sheet_id: str) -> GoogleSheetsClient:
+    return GoogleSheetsClient(sheet_id)
+
+def get_sheets_client(sheet_id: str) -> GoogleSheetsClient:
+    try:
+        return _shared_sheets_client(sheet_id)
+    except Exception as e:
+        st.error(f"Критическая ошибка при подключении к Google Sheets. Проблема с ID таблицы или с авторизацией. {e}")
+        st.stop()
+
 # =========================
 # ПОЛЬЗОВАТЕЛИ (ЛОГИН)
 # =========================
@@ -373,130 +637,148 @@ def login_form(excel: GoogleSheetsClient):
 # CALCULATORS 
 # =========================
 
+@functools.lru_cache(maxsize=16)
+def _imposts_by_flags(has_left: bool, has_center: bool, has_right: bool, has_top: bool):
+    n_imp_vert = max(0, has_left + has_center + has_right - 1)
+    n_imp_hor = int(has_top)
+
+    n_impost = n_imp_vert + n_imp_hor
+    n_frame_rect = 1 + n_impost
+
+    return {
+        "n_imp_vert": n_imp_vert,
+        "n_imp_hor": n_imp_hor,
+        "n_impost": n_impost,
+        "n_frame_rect": n_frame_rect,
+        "n_rect": n_frame_rect,
+        "n_corners": 4 * n_frame_rect,
+    }
+
+def _calc_imposts_context(left, center, right, top):
+    # Геометрия зависит только от того, какие импосты заданы — 16 вариантов, все кешируются.
+    # Возвращаемый словарь общий: только читать / копировать через ctx.update
+    return _imposts_by_flags(left > 0, center > 0, right > 0, top > 0)
+
 class GabaritCalculator:
     HEADER = ["Тип элемента", "Фактическое значение"]
 
     def __init__(self, excel_client: GoogleSheetsClient):
         self.excel = excel_client
 
-    def _calc_imposts_context(self, width, height, left, center, right, top):
-        n_sections_vert = 0
-        if left > 0: n_sections_vert += 1
-        if center > 0: n_sections_vert += 1
-        if right > 0: n_sections_vert += 1
-        
-        n_imp_vert = max(0, n_sections_vert - 1)
-        n_imp_hor = 0
-        if top > 0: n_imp_hor += 1
-
-        n_impost = n_imp_vert + n_imp_hor
-        n_frame_rect = 1 + n_imp_vert + n_imp_hor 
-        n_rect = n_frame_rect
-        n_corners = 4 * n_frame_rect
-
-        return {
-            "n_imp_vert": n_imp_vert,
-            "n_imp_hor": n_imp_hor,
-            "n_impost": n_impost,
-            "n_frame_rect": n_frame_rect,
-            "n_rect": n_rect,
-            "n_corners": n_corners,
+    def _section_context(self, order: dict, s: dict):
+        is_door_section = s.get("kind") == "door"
+        is_non_tamur_section = s.get("kind") in ["window", "door"] and order.get("product_type") != "Тамбур"
+
+        if is_door_section:
+            width = s.get("frame_width_mm", 0.0)
+            height = s.get("frame_height_mm", 0.0)
+        else:
+            width = s.get("width_mm", 0.0)
+            height = s.get("height_mm", 0.0)
+
+        sash_w = 0.0
+        sash_h = 0.0
+
+        if s.get("leaves"):
+            first_leaf = s.get("leaves", [{}])[0]
+            sash_w = first_leaf.get("width_mm", 0.0)
+            sash_h = first_leaf.get("height_mm", 0.0)
+
+        left = s.get("left_mm", 0.0)
+        center = s.get("center_mm", 0.0)
+        right = s.get("right_mm", 0.0)
+        top = s.get("top_mm", 0.0)
+
+        if is_non_tamur_section and (sash_w <= 0.0 or sash_h <= 0.0) and s.get("n_leaves", 0) > 0:
+            C_DED = 60.0
+
+            if sash_w <= 0.0:
+                if left > 0 and center == 0 and right == 0 and s.get("n_leaves", 0) == 1:
+                    sash_w = max(0.0, width - left - C_DED)
+                else:
+                    sash_w = width 
+
+            if sash_h <= 0.0:
+                if top > 0:
+                    sash_h = max(0.0, height - top - C_DED)
+                else:
+                    sash_h = height
+
+        area = s.get("area_m2", 0.0)
+        perimeter = s.get("perimeter_m", 0.0)
+        qty = s.get("Nwin", 1)
+
+        nsash = s.get("n_leaves", len(s.get("leaves", [])) or 0)
+
+        ctx = {
+            "width": width, "height": height, "left": left, "center": center, "right": right, "top": top,
+            "area": area, "perimeter": perimeter, "qty": qty,
+            "sash_width": sash_w, "sash_height": sash_h, "sash_w": sash_w, "sash_h": sash_h,
+            "n_sash": nsash,
+            "n_sash_active": 1 if nsash >= 1 else 0,
+            "n_sash_passive": max(nsash - 1, 0),
+            "hinges_per_sash": 3,
+            "is_door": 1 if is_door_section else 0,
         }
 
+        try:
+            geom = _calc_imposts_context(left, center, right, top)
+            if isinstance(geom, dict):
+                ctx.update(geom)
+        except Exception:
+            pass
+
+        return ctx
+
     def calculate(self, order: dict, sections: list):
         ref_rows = self.excel.read_records(SHEET_REF3)
 
-        total_area = sum(s.get("area_m2", 0.0) * s.get("Nwin", 1) for s in sections)
-        total_perimeter = sum(s.get("perimeter_m", 0.0) * s.get("Nwin", 1) for s in sections)
+        # Контексты секций собираем один раз; итоги — свёртки по столбцам
+        contexts = [prepare_formula_context(self._section_context(order, s)) for s in sections]
+        arrays = _stack_contexts(contexts)
+        total_area, total_perimeter = _section_totals(contexts, arrays)
 
         if not ref_rows:
             return [], total_area, total_perimeter
 
         gabarit_values = []
 
+        get_type_elem = field_getter(ref_rows, "тип элемент", "")
+        get_formula = field_getter(ref_rows, "формула_python", "")
+
         for row in ref_rows:
-            type_elem = get_field(row, "тип элемент", "")
-            formula = get_field(row, "формула_python", "")
+            type_elem = get_type_elem(row)
+            formula = get_formula(row)
             if not type_elem or not formula:
                 continue
 
             total_value = 0.0
 
-            for s in sections:
-                
-                is_door_section = s.get("kind") == "door"
-                is_non_tamur_section = s.get("kind") in ["window", "door"] and order.get("product_type") != "Тамбур"
-
-                if is_door_section:
-                    width = s.get("frame_width_mm", 0.0)
-                    height = s.get("frame_height_mm", 0.0)
-                else:
-                    width = s.get("width_mm", 0.0)
-                    height = s.get("height_mm", 0.0)
-
-                sash_w = 0.0
-                sash_h = 0.0
-
-                if s.get("leaves"):
-                    first_leaf = s.get("leaves", [{}])[0]
-                    sash_w = first_leaf.get("width_mm", 0.0)
-                    sash_h = first_leaf.get("height_mm", 0.0)
-                    
-                left = s.get("left_mm", 0.0)
-                center = s.get("center_mm", 0.0)
-                right = s.get("right_mm", 0.0)
-                top = s.get("top_mm", 0.0)
-                
-                if is_non_tamur_section and (sash_w <= 0.0 or sash_h <= 0.0) and s.get("n_leaves", 0) > 0:
-                    C_DED = 60.0
-                    
-                    if sash_w <= 0.0:
-                        if left > 0 and center == 0 and right == 0 and s.get("n_leaves", 0) == 1:
-                            sash_w = max(0.0, width - left - C_DED)
-                        else:
-                            sash_w = width 
-                    
-                    if sash_h <= 0.0:
-                        if top > 0:
-                            sash_h = max(0.0, height - top - C_DED)
-                        else:
-                            sash_h = height
-
-                area = s.get("area_m2", 0.0)
-                perimeter = s.get("perimeter_m", 0.0)
-                qty = s.get("Nwin", 1)
-
-                nsash = s.get("n_leaves", len(s.get("leaves", [])) or 0)
-
-                ctx = {
-                    "width": width, "height": height, "left": left, "center": center, "right": right, "top": top,
-                    "area": area, "perimeter": perimeter, "qty": qty,
-                    "sash_width": sash_w, "sash_height": sash_h, "sash_w": sash_w, "sash_h": sash_h,
-                    "n_sash": nsash,
-                    "n_sash_active": 1 if nsash >= 1 else 0,
-                    "n_sash_passive": max(nsash - 1, 0),
-                    "hinges_per_sash": 3,
-                    "is_door": 1 if is_door_section else 0,
-                }
-
-                try:
-                    geom = self._calc_imposts_context(width, height, left, center, right, top)
-                    if isinstance(geom, dict):
-                        ctx.update(geom)
-                except Exception:
-                    pass
-
-                try:
-                    calculated_value = safe_eval_formula(str(formula), ctx) * qty 
-                    total_value += calculated_value
-                except Exception:
-                    logger.exception("Error evaluating formula for element %s", type_elem)
+            # Сначала пробуем посчитать формулу сразу по массивам всех секций
+            vector_total = eval_formula_vectorized(str(formula), arrays) if arrays else None
+            if vector_total is not None:
+                total_value = vector_total
+            else:
+                compiled = compile_formula(str(formula))
+                values = []
+                for ctx in contexts:
+                    try:
+                        values.append(eval_compiled_formula(compiled, ctx, formula, prepared=True) * ctx["qty"])
+                    except Exception:
+                        logger.exception("Error evaluating formula for element %s", type_elem)
+                total_value = math.fsum(values)
 
             gabarit_values.append([type_elem, total_value])
 
-        self.excel.clear_and_write(SHEET_GABARITS, self.HEADER, gabarit_values)
         return gabarit_values, total_area, total_perimeter
 
+# Знаков после запятой, до которых округляется расход перед подсчётом упаковок
+_PACK_ROUND_DIGITS = 9
+
+# Позиции дверного блока: для Тамбура считаются только по дверным секциям
+_DOOR_ITEM_MARKERS = ("рама двери", "порог дверной", "створочный профиль", "петля", "замок",
+                      "цилиндр", "ручка", "фиксатор", "доводчик")
+
 class MaterialCalculator:
     HEADER = [
         "Тип изделия", "Система профиля", "Тип элемента", "Артикул", "Товар",
@@ -508,292 +790,329 @@ class MaterialCalculator:
     def __init__(self, excel_client: GoogleSheetsClient):
         self.excel = excel_client
 
-    def _calc_imposts_context(self, width, height, left, center, right, top):
-        n_sections_vert = 0
-        if left > 0: n_sections_vert += 1
-        if center > 0: n_sections_vert += 1
-        if right > 0: n_sections_vert += 1
+    def _section_context(self, order: dict, s: dict):
+        is_door_section = s.get("kind") == "door"
+        is_non_tamur_section = s.get("kind") in ["window", "door"] and order.get("product_type") != "Тамбур"
+        
+        if is_door_section:
+            width = s.get("frame_width_mm", 0.0)
+            height = s.get("frame_height_mm", 0.0)
+        else:
+            width = s.get("width_mm", 0.0)
+            height = s.get("height_mm", 0.0)
+
+        left = s.get("left_mm", 0.0)
+        center = s.get("center_mm", 0.0)
+        right = s.get("right_mm", 0.0)
+        top = s.get("top_mm", 0.0)
+        
+        nsash = s.get("n_leaves", len(s.get("leaves", [])) or 0)
+        sash_w = 0.0
+        sash_h = 0.0
+
+        if nsash > 0 and s.get("leaves"):
+            first_leaf = s.get("leaves", [{}])[0]
+            sash_w = first_leaf.get("width_mm", 0.0)
+            sash_h = first_leaf.get("height_mm", 0.0)
+            
+        if is_non_tamur_section and nsash > 0 and (sash_w <= 0.0 or sash_h <= 0.0):
+            C_DED = 60.0 
+            
+            if sash_w <= 0.0:
+                if left > 0 and center == 0 and right == 0 and nsash == 1:
+                    sash_w = max(0.0, width - left - C_DED)
+                else:
+                    sash_w = width
+            
+            if sash_h <= 0.0:
+                if top > 0:
+                    sash_h = max(0.0, height - top - C_DED)
+                else:
+                    sash_h = height
+            
+        area = s.get("area_m2", 0.0)
+        perimeter = s.get("perimeter_m", 0.0)
+        qty = s.get("Nwin", 1)
+
+        geom = _calc_imposts_context(left, center, right, top)
         
-        n_imp_vert = max(0, n_sections_vert - 1)
-        n_imp_hor = 0
-        if top > 0: n_imp_hor += 1
-
-        n_impost = n_imp_vert + n_imp_hor
-        n_frame_rect = 1 + n_imp_vert + n_imp_hor
-        n_rect = n_frame_rect
-        n_corners = 4 * n_frame_rect
-
-        return {
-            "n_imp_vert": n_imp_vert, "n_imp_hor": n_imp_hor, "n_impost": n_impost,
-            "n_frame_rect": n_frame_rect, "n_rect": n_rect, "n_corners": n_corners,
+        ctx = {
+            "width": width, "height": height, "left": left, "center": center, "right": right, "top": top,
+            "sash_width": sash_w, "sash_height": sash_h, "sash_w": sash_w, "sash_h": sash_h,
+            "area": area, "perimeter": perimeter, "qty": qty,
+            "nsash": nsash,
+            "n_sash": nsash, 
+            "n_sash_active": 1 if nsash >= 1 else 0,
+            "n_sash_passive": max(nsash - 1, 0),
+            "hinges_per_sash": 3,
+            "is_door": 1 if is_door_section else 0,
         }
+        ctx.update(geom)
+        return ctx
+
+    def _material_row(self, row: dict, row_type, row_profile, type_elem: str, product_name: str,
+                      formula, row_contexts: list, row_arrays: dict, unit_price: float, norm_per_pack: float,
+                      fields: dict):
+        # Строка справочника считается независимо от остальных: расход по секциям,
+        # упаковки и сумма. Пул потоков здесь не помогает — eval держит GIL
+        qty_fact_total = 0.0
+
+        vector_total = eval_formula_vectorized(str(formula), row_arrays) if row_arrays else None
+        if vector_total is not None:
+            qty_fact_total = vector_total
+        else:
+            compiled = compile_formula(str(formula))
+            values = []
+            for ctx in row_contexts:
+                try:
+                    values.append(eval_compiled_formula(compiled, ctx, formula, prepared=True) * ctx["qty"])
+                except Exception:
+                    logger.exception("Error evaluating material formula for %s (Formula: %s)", type_elem, formula)
+            qty_fact_total = math.fsum(values)
+
+        unit_pack = str(fields["unit_pack"](row) or "").strip()
+        unit = str(fields["unit"](row) or "").strip()
+        unit_fact = str(fields["unit_fact"](row) or "").strip()
+
+        if norm_per_pack > 0:
+            # Шум последних разрядов float (90.00000000000001) не должен давать лишнюю упаковку
+            qty_for_packs = round(qty_fact_total, _PACK_ROUND_DIGITS)
+            # Для целых норм (штуки, комплекты) — целочисленное деление вверх без float
+            if norm_per_pack.is_integer() and float(qty_for_packs).is_integer():
+                qty_to_ship = -(-int(qty_for_packs) // int(norm_per_pack))
+            else:
+                qty_to_ship = math.ceil(round(qty_for_packs / norm_per_pack, _PACK_ROUND_DIGITS))
+            effective_qty = qty_to_ship * norm_per_pack
+        else:
+            qty_to_ship = qty_fact_total
+            effective_qty = qty_fact_total
+
+        sum_row = effective_qty * unit_price
+
+        return [
+            row_type if row_type is not None else "",
+            row_profile if row_profile is not None else "",
+            type_elem,
+            fields["article"](row),
+            product_name,
+            unit,
+            unit_price,
+            unit_fact,
+            qty_fact_total,
+            norm_per_pack,
+            unit_pack,
+            qty_to_ship,
+            sum_row
+        ], sum_row
 
     def calculate(self, order: dict, sections: list, selected_duplicates: dict):
         ref_rows = self.excel.read_records(SHEET_REF1)
-        total_area = sum(s.get("area_m2", 0.0) * s.get("Nwin", 1) for s in sections)
+
+        # Контекст секции не зависит от строки справочника — собираем его один раз
+        # и укладываем в массивы, чтобы формула считалась сразу по всем секциям
+        contexts = [prepare_formula_context(self._section_context(order, s)) for s in sections]
+        arrays = _stack_contexts(contexts)
+        total_area, _ = _section_totals(contexts, arrays)
+
         if not ref_rows:
             return [], 0.0, total_area
 
         result_rows = []
         total_sum = 0.0
 
-        for row in ref_rows:
-            row_type = get_field(row, "тип издел", "")
-            row_profile = get_field(row, "система проф", "")
-            type_elem = get_field(row, "тип элемент", "")
-            product_name = str(get_field(row, "товар", "") or "")
-            
-            if row_type and str(row_type).strip().lower() != order.get("product_type", "").strip().lower():
-                continue
+        door_contexts = [ctx for ctx, s in zip(contexts, sections) if s.get("kind") != "panel"]
+        door_arrays = _stack_contexts(door_contexts)
+
+        # Параметры заказа не меняются по строкам справочника — нормализуем их заранее
+        order_product_type = order.get("product_type", "").strip().lower()
+        order_profile = order.get("profile_system", "").strip().lower()
+        is_tambur = order.get("product_type") == "Тамбур"
+        get_selected = selected_duplicates.get
+
+        # Цены и нормы упаковки приводятся к числам столбцом, а не по строке
+        unit_prices = self.excel.read_numeric_column(SHEET_REF1, "цена за")
+        norms_per_pack = self.excel.read_numeric_column(SHEET_REF1, "кол-во норм")
+
+        # Колонки ref1 находим по заголовку один раз, а не в каждой строке
+        get_type = field_getter(ref_rows, "тип издел", "")
+        get_profile = field_getter(ref_rows, "система проф", "")
+        get_type_elem = field_getter(ref_rows, "тип элемент", "")
+        get_product = field_getter(ref_rows, "товар", "")
+        get_formula = field_getter(ref_rows, "формула_python", "")
+        get_formula_fact = field_getter(ref_rows, "формула фактического расхода", "")
+        fields = {
+            "article": field_getter(ref_rows, "артикул", ""),
+            "unit_pack": field_getter(ref_rows, "ед .норма к упаковке", ""),
+            "unit": field_getter(ref_rows, "ед.", ""),
+            "unit_fact": field_getter(ref_rows, "ед. фактического расхода", ""),
+        }
 
-            if row_profile and str(row_profile).strip().lower() != order.get("profile_system", "").strip().lower():
-                continue
+        # Только строки своего типа изделия и профиля (или с пустыми — для любых),
+        # в исходном порядке справочника
+        groups = self.excel.read_row_groups(SHEET_REF1, ("тип издел", "система проф"))
+        candidates = sorted(
+            i
+            for key in ((order_product_type, order_profile), (order_product_type, None),
+                        (None, order_profile), (None, None))
+            for i in groups.get(key, ())
+        )
 
-            if type_elem in selected_duplicates and selected_duplicates[type_elem]:
-                chosen_names = selected_duplicates[type_elem]
-                if product_name not in chosen_names:
-                    continue
+        for i in candidates:
+            row = ref_rows[i]
+            row_type = get_type(row)
+            row_profile = get_profile(row)
+            type_elem = get_type_elem(row)
+            product_name = str(get_product(row) or "")
+
+            chosen_names = get_selected(type_elem)
+            if chosen_names and product_name not in chosen_names:
+                continue
                 
-            formula = get_field(row, "формула_python", "")
+            formula = get_formula(row)
             if not formula:
-                formula = get_field(row, "формула фактического расхода", "") 
+                formula = get_formula_fact(row)
             if not formula:
                 continue
 
-            qty_fact_total = 0.0
-            
-            is_door_item = ("рама двери" in type_elem.lower() or "порог дверной" in type_elem.lower() or "створочный профиль" in type_elem.lower() or "петля" in type_elem.lower() or "замок" in type_elem.lower() or "цилиндр" in type_elem.lower() or "ручка" in type_elem.lower() or "фиксатор" in type_elem.lower() or "доводчик" in type_elem.lower())
+            type_elem_lower = type_elem.lower()
+            is_door_item = any(marker in type_elem_lower for marker in _DOOR_ITEM_MARKERS)
 
-            for s in sections:
-                is_door_section = s.get("kind") == "door"
-                is_non_tamur_section = s.get("kind") in ["window", "door"] and order.get("product_type") != "Тамбур"
-                
-                if order.get("product_type") == "Тамбур":
-                    if is_door_item and s.get("kind") == "panel":
-                        continue
-                
-                if is_door_section:
-                    width = s.get("frame_width_mm", 0.0)
-                    height = s.get("frame_height_mm", 0.0)
-                else:
-                    width = s.get("width_mm", 0.0)
-                    height = s.get("height_mm", 0.0)
+            if is_tambur and is_door_item:
+                row_contexts, row_arrays = door_contexts, door_arrays
+            else:
+                row_contexts, row_arrays = contexts, arrays
 
-                left = s.get("left_mm", 0.0)
-                center = s.get("center_mm", 0.0)
-                right = s.get("right_mm", 0.0)
-                top = s.get("top_mm", 0.0)
-                
-                nsash = s.get("n_leaves", len(s.get("leaves", [])) or 0)
-                sash_w = 0.0
-                sash_h = 0.0
-
-                if nsash > 0 and s.get("leaves"):
-                    first_leaf = s.get("leaves", [{}])[0]
-                    sash_w = first_leaf.get("width_mm", 0.0)
-                    sash_h = first_leaf.get("height_mm", 0.0)
-                    
-                if is_non_tamur_section and nsash > 0 and (sash_w <= 0.0 or sash_h <= 0.0):
-                    C_DED = 60.0 
-                    
-                    if sash_w <= 0.0:
-                        if left > 0 and center == 0 and right == 0 and nsash == 1:
-                            sash_w = max(0.0, width - left - C_DED)
-                        else:
-                            sash_w = width
-                    
-                    if sash_h <= 0.0:
-                        if top > 0:
-                            sash_h = max(0.0, height - top - C_DED)
-                        else:
-                            sash_h = height
-                    
-                area = s.get("area_m2", 0.0)
-                perimeter = s.get("perimeter_m", 0.0)
-                qty = s.get("Nwin", 1)
+            result_row, sum_row = self._material_row(row, row_type, row_profile, type_elem, product_name,
+                                                     formula, row_contexts, row_arrays,
+                                                     unit_prices[i], norms_per_pack[i], fields)
+            total_sum += sum_row
+            result_rows.append(result_row)
 
-                geom = self._calc_imposts_context(width, height, left, center, right, top)
-                
-                ctx = {
-                    "width": width, "height": height, "left": left, "center": center, "right": right, "top": top,
-                    "sash_width": sash_w, "sash_height": sash_h, "sash_w": sash_w, "sash_h": sash_h,
-                    "area": area, "perimeter": perimeter, "qty": qty,
-                    "nsash": nsash,
-                    "n_sash": nsash, 
-                    "n_sash_active": 1 if nsash >= 1 else 0,
-                    "n_sash_passive": max(nsash - 1, 0),
-                    "hinges_per_sash": 3,
-                    "is_door": 1 if is_door_section else 0,
-                }
-                ctx.update(geom)
+        return result_rows, total_sum, total_area
 
-                try:
-                    calculated_value = safe_eval_formula(str(formula), ctx) * qty
-                    qty_fact_total += calculated_value
-                except Exception:
-                    logger.exception("Error evaluating material formula for %s (Formula: %s)", type_elem, formula)
+def _area_price_header(hk: str, needles: tuple) -> bool:
+    # Цена за м²: исключаем явные счетчики (шт), требуем иглу и 'стоимость'/'цена'
+    is_area_price = "за м" in hk
+    is_excluded_item = any(exc in hk for exc in ("ручк", "доводчик", "шт"))
+    if is_excluded_item and not is_area_price:
+        return False
+    return any(n in hk for n in needles) and ("стоимость" in hk or "цена" in hk)
 
-            unit_price = safe_float(get_field(row, "цена за", 0.0))
-            norm_per_pack = safe_float(get_field(row, "кол-во норм", 0.0))
-            unit_pack = str(get_field(row, "ед .норма к упаковке", "") or "").strip()
-            unit = str(get_field(row, "ед.", "") or "").strip()
-            unit_fact = str(get_field(row, "ед. фактического расхода", "") or "").strip()
 
-            if norm_per_pack > 0:
-                qty_to_ship = math.ceil(qty_fact_total / norm_per_pack)
-                effective_qty = qty_to_ship * norm_per_pack
-            else:
-                qty_to_ship = qty_fact_total
-                effective_qty = qty_fact_total
+def _piece_price_header(hk: str, needle: str) -> bool:
+    # Цена за штуку
+    return needle in hk and ("стоимость" in hk or "цена" in hk) and "шт" in hk
 
-            sum_row = effective_qty * unit_price
-            total_sum += sum_row
 
-            result_rows.append([
-                row_type if row_type is not None else "",
-                row_profile if row_profile is not None else "",
-                type_elem,
-                get_field(row, "артикул", ""),
-                product_name,
-                unit,
-                unit_price,
-                unit_fact,
-                qty_fact_total,
-                norm_per_pack,
-                unit_pack,
-                qty_to_ship,
-                sum_row
-            ])
+# Метрика прайса (СПРАВОЧНИК-2) -> условие на заголовок столбца цены
+_REF2_PRICE_HEADERS = (
+    ("montage", lambda hk: _area_price_header(hk, ("монтаж", "за м"))),
+    ("toning", lambda hk: _area_price_header(hk, ("тониров", "за м"))),
+    ("assembly", lambda hk: _area_price_header(hk, ("сбор", "за м"))),
+    ("glass", lambda hk: "стоимость" in hk and ("стеклопак" in hk or "за м" in hk)),
+    ("handles", lambda hk: _piece_price_header(hk, "ручк")),
+    ("closer", lambda hk: _piece_price_header(hk, "доводчик")),
+)
 
-        self.excel.clear_and_write(SHEET_MATERIAL, self.HEADER, result_rows)
-        return result_rows, total_sum, total_area
 
 class FinalCalculator:
     HEADER = ["Наименование услуг", "Стоимость за м²/шт", "Ед", "Итого"]
 
     def __init__(self, excel_client: GoogleSheetsClient):
         self.excel = excel_client
+        self._ref2_rows = None
+        self._glass_index = None
+        self._filling_index = None
+        self._price_key_index = None
 
     def _lookup_ref2_rows(self):
-        return self.excel.read_records(SHEET_REF2)
+        # Прайс читается один раз на калькулятор, а не в каждом _find_price_*
+        if self._ref2_rows is None:
+            self._ref2_rows = self.excel.read_records(SHEET_REF2)
+        return self._ref2_rows
 
-    def _find_price_by_header_match(self, needle_list: list, default=0.0):
+    def _ref2_keys(self, *needles):
+        # Заголовки одинаковы во всех строках прайса — ищем их по первой строке
         ref2 = self._lookup_ref2_rows()
-        if not ref2: return default
-        
-        for r in ref2:
-            for k in r.keys():
+        if not ref2: return []
+        return [k for k in ref2[0] if k is not None and any(n in str(k).lower() for n in needles)]
+
+    def _glass_rows_by_type(self):
+        # Тип стеклопакета -> первая строка прайса с этим типом
+        if self._glass_index is None:
+            index = {}
+            type_keys = self._ref2_keys("тип стеклопак")
+            for r in self._lookup_ref2_rows():
+                for k in type_keys:
+                    v = r.get(k)
+                    if v:
+                        index.setdefault(str(v).strip().lower(), r)
+            self._glass_index = index
+        return self._glass_index
+
+    def _price_keys(self):
+        # Заголовки одинаковы во всех строках прайса: за один проход по ним
+        # находим столбец цены для каждой метрики (первый подходящий, как раньше)
+        if self._price_key_index is None:
+            ref2 = self._lookup_ref2_rows()
+            index = {}
+            for k in (ref2[0].keys() if ref2 else ()):
                 if k is None: continue
                 hk = str(k).lower()
-                
-                # УСИЛЕНО: Теперь ищем четкое совпадение иглой (needle)
-                # И исключаем явные счетчики (шт)
-                is_area_price = any(term in hk for term in ["за м", "за м²"])
-                is_excluded_item = any(exc in hk for exc in ["ручк", "доводчик", "шт"])
-                
-                if is_excluded_item and not is_area_price:
-                    continue
+                for metric, match in _REF2_PRICE_HEADERS:
+                    if metric not in index and match(hk):
+                        index[metric] = k
+            self._price_key_index = index
+        return self._price_key_index
 
-                for needle in needle_list:
-                    # Ищем совпадение иглы И обязательно ищем слово 'стоимость' или 'цена'
-                    if needle in hk and any(p in hk for p in ["стоимость", "цена"]):
-                        return safe_float(r.get(k), default)
-        return default
+    def _find_price_by_metric(self, metric: str, row=None, default=0.0):
+        ref2 = self._lookup_ref2_rows()
+        key = self._price_keys().get(metric)
+        if not ref2 or key is None: return default
+        return safe_float((row or ref2[0]).get(key), default)
+
+    def _filling_prices(self):
+        # Заполнение (нормализованное) -> стоимость из первой подходящей строки прайса
+        if self._filling_index is None:
+            index = {}
+            price_keys = self._ref2_keys("стоимость")
+            fill_keys = self._ref2_keys("панел", "заполн") if price_keys else []
+            for r in self._lookup_ref2_rows():
+                for k in fill_keys:
+                    v = r.get(k)
+                    if v:
+                        index.setdefault(str(v).strip().lower(), safe_float(r[price_keys[0]], 0.0))
+            self._filling_index = index
+        return self._filling_index
 
     def _find_price_for_filling(self, filling_value):
-        ref2 = self._lookup_ref2_rows()
-        if not ref2: return 0.0
         fv = str(filling_value or "").strip().lower()
-        
-        for r in ref2:
-            fill_key_found = None
-            
-            for k in r.keys():
-                if k is None: continue
-                if "панел" in str(k).lower() or "заполн" in str(k).lower():
-                    if str(r.get(k) or "").strip().lower() == fv:
-                        fill_key_found = r[k]
-                        break
-            
-            if fill_key_found:
-                for kk in r.keys():
-                    if kk is None: continue
-                    if "стоимость" in str(kk).lower():
-                        return safe_float(r[kk], 0.0)
-                        
-        return 0.0
+        return self._filling_prices().get(fv, 0.0)
 
     def _find_price_for_montage(self, montage_type):
-        # Ищем монтаж
         # Иглы: ['монтаж', 'стоимость', 'за м']
-        return self._find_price_by_header_match(["монтаж", "за м"], 0.0)
+        return self._find_price_by_metric("montage")
 
     def _find_price_for_glass_by_type(self, glass_type):
-        ref2 = self._lookup_ref2_rows()
-        if not ref2: return 0.0
         gt = str(glass_type or "").strip().lower()
-        
-        chosen = None
-        for r in ref2:
-            for k in r.keys():
-                if k is None: continue
-                if "тип стеклопак" in str(k).lower():
-                    v = r.get(k)
-                    if v and str(v).strip().lower() == gt:
-                        chosen = r
-                        break
-            if chosen: break
-            
-        if not chosen:
-            for r in ref2:
-                for k in r.keys():
-                    if k is None: continue
-                    hk = str(k).lower()
-                    if "стоимость" in hk and ("стеклопак" in hk or "за м" in hk):
-                        return safe_float(r.get(k), 0.0)
-            return 0.0
-        
-        for k in chosen.keys():
-            if k is None: continue
-            hk = str(k).lower()
-            if "стоимость" in hk and ("стеклопак" in hk or "за м" in hk or "за м²" in hk):
-                return safe_float(chosen.get(k), 0.0)
-        return 0.0
+        # Строка выбранного типа, иначе первая строка прайса
+        return self._find_price_by_metric("glass", self._glass_rows_by_type().get(gt))
 
     def _find_price_for_toning(self):
         # Иглы: ['тониров', 'стоимость', 'за м']
-        return self._find_price_by_header_match(["тониров", "за м"], 0.0)
+        return self._find_price_by_metric("toning")
 
     def _find_price_for_assembly(self):
         # Иглы: ['сбор', 'стоимость', 'за м']
-        return self._find_price_by_header_match(["сбор", "за м"], 0.0)
+        return self._find_price_by_metric("assembly")
 
     def _find_price_for_handles(self):
         # Строгий поиск ручек (за штуку)
-        ref2 = self._lookup_ref2_rows()
-        if not ref2: return 0.0
-        
-        for r in ref2:
-            for k in r.keys():
-                if k is None: continue
-                hk = str(k).lower()
-                if "ручк" in hk and ("стоимость" in hk or "цена" in hk) and "шт" in hk:
-                    return safe_float(r.get(k), 0.0)
-        return 0.0
+        return self._find_price_by_metric("handles")
     
     def _find_price_for_closer(self):
         # Строгий поиск доводчиков (за штуку)
-        ref2 = self._lookup_ref2_rows()
-        if not ref2: return 0.0
-        
-        for r in ref2:
-            for k in r.keys():
-                if k is None: continue
-                hk = str(k).lower()
-                if "доводчик" in hk and ("стоимость" in hk or "цена" in hk) and "шт" in hk:
-                    return safe_float(r.get(k), 0.0)
-        return 0.0
-
+        return self._find_price_by_metric("closer")
 
     def calculate(self, order: dict, total_area_all: float, material_total: float, lambr_cost: float = 0.0, handles_qty: int = 0, closer_qty: int = 0):
         
@@ -847,9 +1166,6 @@ class FinalCalculator:
 
         # ИТОГО
         total_sum = base_sum + ensure_sum
-        extra_rows = [["ИТОГО", "", "", total_sum]]
-
-        self.excel.clear_and_write(SHEET_FINAL, self.HEADER, rows + extra_rows)
         return rows, total_sum, ensure_sum
 
 
@@ -857,6 +1173,40 @@ class FinalCalculator:
 # EXPORT: коммерческое предложение 
 # =========================
 
+# Контакты компании в шапке сметы не меняются между заказами
+_SMETA_CONTACT_LINES = (COMPANY_NAME, COMPANY_CITY, f"Тел.: {COMPANY_PHONE}", f"E-mail: {COMPANY_EMAIL}") + (
+    (f"Сайт: {COMPANY_SITE}",) if COMPANY_SITE else ()
+)
+
+# Сведения о заказе в смете: (шаблон строки, ключ заказа, прочерк вместо пустого значения)
+_SMETA_ORDER_FIELDS = (
+    ("Заказ № {}", "order_number", False),
+    ("Тип изделия: {}", "product_type", False),
+    ("Профильная система: {}", "profile_system", False),
+    ("Тип заполнения (панели): {}", "filling_mode", True),
+    ("Тип стеклопакета: {}", "glass_type", False),
+    ("Тонировка: {}", "toning", False),
+    ("Сборка: {}", "assembly", False),
+    ("Монтаж: {}", "montage", False),
+    ("Тип ручек: {}", "handle_type", True),
+    ("Доводчик: {}", "door_closer", False),
+)
+
+def _smeta_position_line(idx: int, p: dict, is_tambur: bool) -> str:
+    # Дверь тамбура описывается размером рамы, остальные позиции — своим
+    if p.get('kind') == 'door' and is_tambur:
+        w = p.get('frame_width_mm', 0)
+        h = p.get('frame_height_mm', 0)
+    else:
+        w = p.get('width_mm', 0)
+        h = p.get('height_mm', 0)
+
+    leaves = p.get('leaves')
+    fill = p.get('filling', '') or (leaves[0].get('filling', '') if leaves else '')
+    return f"Позиция {idx}: {p.get('kind','').capitalize()}, {w} × {h} мм, N = {p.get('Nwin',1)}, заполнение={fill}"
+
+# Повторный расчёт с теми же данными заказа отдаёт уже собранный файл
+@st.cache_data(show_spinner=False, max_entries=32)
 def build_smeta_workbook(order: dict,
                          base_positions: list,
                          lambr_positions: list,
@@ -864,26 +1214,19 @@ def build_smeta_workbook(order: dict,
                          total_perimeter: float,
                          total_sum: float) -> bytes:
     
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Коммерческое предложение"
+    # Документ пишется один раз сверху вниз — потоковый режим без дерева ячеек в памяти
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Коммерческое предложение")
 
-    current_row = 1
-    
-    # Контакты
-    contact_col = 3
-    ws.cell(row=current_row, column=contact_col, value=COMPANY_NAME); current_row += 1
-    ws.cell(row=current_row, column=contact_col, value=COMPANY_CITY); current_row += 1
-    ws.cell(row=current_row, column=contact_col, value=f"Тел.: {COMPANY_PHONE}"); current_row += 1
-    ws.cell(row=current_row, column=contact_col, value=f"E-mail: {COMPANY_EMAIL}"); current_row += 1
-    if COMPANY_SITE:
-        ws.cell(row=current_row, column=contact_col, value=f"Сайт: {COMPANY_SITE}"); current_row += 1
-
-    current_row += 1
-    # ИСПРАВЛЕНО: Безопасная запись значения (для устранения NoneType)
-    cell = ws.cell(row=current_row, column=1, value="Коммерческое предложение")
-    cell.value = str(cell.value).replace('\xa0', ' ')
-    current_row += 2
+    # Все строки собираем списком и пишем через ws.append (пустой список — пустая строка)
+    rows = []
+
+    # Контакты (колонка C)
+    rows.extend([None, None, line] for line in _SMETA_CONTACT_LINES)
+
+    rows.append([])
+    rows.append(["Коммерческое предложение"])
+    rows.append([])
 
     # Общая информация о заказе
     filling_mode_val = order.get('filling_mode', '')
@@ -894,90 +1237,47 @@ def build_smeta_workbook(order: dict,
         else:
              filling_mode_val = fill_val 
 
-    # ИСПРАВЛЕНО: Безопасная запись значения для Заказ №
-    cell = ws.cell(row=current_row, column=1, value=f"Заказ № {order.get('order_number','')}")
-    cell.value = str(cell.value).replace('\xa0', ' '); current_row += 1
-    
-    # ИСПРАВЛЕНО: Безопасная запись значения для Тип изделия
-    cell = ws.cell(row=current_row, column=1, value=f"Тип изделия: {order.get('product_type','')}")
-    cell.value = str(cell.value).replace('\xa0', ' '); current_row += 1
-    
-    # ИСПРАВЛЕНО: Безопасная запись значения для Профильная система
-    cell = ws.cell(row=current_row, column=1, value=f"Профильная система: {order.get('profile_system','')}")
-    cell.value = str(cell.value).replace('\xa0', ' '); current_row += 1
-    
-    # ИСПРАВЛЕНО: Безопасная запись значения для Тип заполнения
-    cell = ws.cell(row=current_row, column=1, value=f"Тип заполнения (панели): {filling_mode_val or '—'}")
-    cell.value = str(cell.value).replace('\xa0', ' '); current_row += 1
-    
-    # ИСПРАВЛЕНО: Безопасная запись значения для Тип стеклопакета
-    cell = ws.cell(row=current_row, column=1, value=f"Тип стеклопакета: {order.get('glass_type','')}")
-    cell.value = str(cell.value).replace('\xa0', ' '); current_row += 1
-    
-    # ИСПРАВЛЕНО: Безопасная запись значения для Тонировка
-    cell = ws.cell(row=current_row, column=1, value=f"Тонировка: {order.get('toning','')}")
-    cell.value = str(cell.value).replace('\xa0', ' '); current_row += 1
-    
-    # ИСПРАВЛЕНО: Безопасная запись значения для Сборка
-    cell = ws.cell(row=current_row, column=1, value=f"Сборка: {order.get('assembly','')}")
-    cell.value = str(cell.value).replace('\xa0', ' '); current_row += 1
-    
-    # ИСПРАВЛЕНО: Безопасная запись значения для Монтаж
-    cell = ws.cell(row=current_row, column=1, value=f"Монтаж: {order.get('montage','')}")
-    cell.value = str(cell.value).replace('\xa0', ' '); current_row += 1
-    
-    # ИСПРАВЛЕНО: Безопасная запись значения для Тип ручек
-    cell = ws.cell(row=current_row, column=1, value=f"Тип ручек: {order.get('handle_type','') or '—'}")
-    cell.value = str(cell.value).replace('\xa0', ' '); current_row += 1
-    
-    # ИСПРАВЛЕНО: Безопасная запись значения для Доводчик
-    cell = ws.cell(row=current_row, column=1, value=f"Доводчик: {order.get('door_closer','')}")
-    cell.value = str(cell.value).replace('\xa0', ' '); current_row += 2
+    order_fields = dict(order, filling_mode=filling_mode_val)
+    for template, key, dash in _SMETA_ORDER_FIELDS:
+        value = order_fields.get(key, '')
+        rows.append([template.format((value or '—') if dash else value)])
+    rows.append([])
 
-    ws.cell(row=current_row, column=1, value="Состав позиции:"); current_row += 1
+    rows.append(["Состав позиции:"])
 
     # Детализация позиций
-    for idx, p in enumerate(base_positions, start=1):
-        if p.get('kind') == 'door' and order.get('product_type') == 'Тамбур':
-            w = p.get('frame_width_mm', 0)
-            h = p.get('frame_height_mm', 0)
-        else:
-            w = p.get('width_mm', 0)
-            h = p.get('height_mm', 0)
-            
-        fill = p.get('filling', '') or (p.get('leaves', [{}])[0].get('filling', '') if p.get('leaves') else '')
-        
-        cell = ws.cell(row=current_row, column=1, value=f"Позиция {idx}: {p.get('kind','').capitalize()}, {w} × {h} мм, N = {p.get('Nwin',1)}, заполнение={fill}")
-        cell.value = str(cell.value).replace('\xa0', ' ')
-        current_row += 1
+    is_tambur = order.get('product_type') == 'Тамбур'
+    rows.extend([_smeta_position_line(idx, p, is_tambur)] for idx, p in enumerate(base_positions, start=1))
 
     if lambr_positions:
-        current_row += 1
-        ws.cell(row=current_row, column=1, value="Панели Ламбри / Сэндвич:"); current_row += 1
-        for idx, p in enumerate(lambr_positions, start=1):
-            w = p.get('width_mm', 0)
-            h = p.get('height_mm', 0)
-            cell = ws.cell(row=current_row, column=1, value=f"Панель {idx}: {w} × {h} мм, N = {p.get('Nwin',1)}, заполнение={p.get('filling','')}").value
-            cell = str(cell).replace('\xa0', ' ')
-            current_row += 1
-
-    current_row += 2
-    cell = ws.cell(row=current_row, column=1, value=f"Общая площадь: {total_area:.3f} м²")
-    cell.value = str(cell.value).replace('\xa0', ' '); current_row += 1
-    cell = ws.cell(row=current_row, column=1, value=f"Суммарный периметр: {total_perimeter:.3f} м")
-    cell.value = str(cell.value).replace('\xa0', ' '); current_row += 1
-    cell = ws.cell(row=current_row, column=1, value=f"ИТОГО к оплате: {total_sum:.2f}")
-    cell.value = str(cell.value).replace('\xa0', ' ')
+        rows.append([])
+        rows.append(["Панели Ламбри / Сэндвич:"])
+        rows.extend(
+            [f"Панель {idx}: {p.get('width_mm', 0)} × {p.get('height_mm', 0)} мм, "
+             f"N = {p.get('Nwin',1)}, заполнение={p.get('filling','')}"]
+            for idx, p in enumerate(lambr_positions, start=1)
+        )
 
-    try:
-        for col in ['A','B','C','D','E','F']:
-            ws.column_dimensions[col].width = 25
-    except Exception:
-        pass
+    rows.append([])
+    rows.append([])
+    rows.append([f"Общая площадь: {total_area:.3f} м²"])
+    rows.append([f"Суммарный периметр: {total_perimeter:.3f} м"])
+    rows.append([f"ИТОГО к оплате: {total_sum:.2f}"])
+
+    # Ширину задаём только колонкам с текстом (A — документ, C — контакты);
+    # в потоковом режиме это делается до первой строки
+    used_cols = {i for row in rows for i, v in enumerate(row, start=1) if v is not None}
+    for i in sorted(used_cols):
+        ws.column_dimensions[get_column_letter(i)].width = 25
 
+    # Безопасная запись значений: неразрывные пробелы заменяем обычными
+    for row in rows:
+        ws.append([v.replace('\xa0', ' ') if isinstance(v, str) else v for v in row])
+
+    # Результат кешируется st.cache_data, поэтому отдаём bytes, а не BytesIO;
+    # getvalue() не зависит от позиции, seek(0) не нужен
     buffer = BytesIO()
     wb.save(buffer)
-    buffer.seek(0)
     return buffer.getvalue()
 
 
@@ -988,77 +1288,87 @@ def build_smeta_workbook(order: dict,
 def ensure_session_state():
     if "tam_door_count" not in st.session_state:
         st.session_state["tam_door_count"] = 0
-    if "tam_panel_count" not in st.session_state:
-        st.session_state["tam_panel_count"] = 0
     if "sections_inputs" not in st.session_state:
         st.session_state["sections_inputs"] = []
-    if 'pos_count' not in st.session_state:
-        st.session_state['pos_count'] = 1
+
+_LAMBR_FILLINGS = ("ламбри без термо", "ламбри с термо", "сэндвич")
 
 def _calculate_lambr_cost(sections: list, fin_calc: FinalCalculator):
-    lambr_cost = 0.0
-    
+    fills = []
     for s in sections:
-        
-        fills = []
         if s.get("kind") == "door" and s.get("leaves"):
             for leaf in s["leaves"]:
                 fills.append((str(leaf.get("filling") or "").strip().lower(), leaf.get("width_mm", 0.0), leaf.get("height_mm", 0.0), s.get("Nwin", 1)))
         elif s.get("kind") in ["panel", "window"]:
             fills.append((str(s.get("filling") or "").strip().lower(), s.get("width_mm", 0.0), s.get("height_mm", 0.0), s.get("Nwin", 1)))
-            
-        for fill_name, w_mm, h_mm, nwin in fills:
-            if fill_name in ["ламбри без термо", "ламбри с термо", "сэндвич"]:
-                price_per_meter = fin_calc._find_price_for_filling(fill_name)
-                
-                if price_per_meter > 0:
-                    perimeter_m = 2 * (w_mm + h_mm) / 1000.0
-                    
-                    count_hlyst = math.ceil(perimeter_m / 6.0) if perimeter_m > 0 else 0
-                    price_per_hlyst = price_per_meter * 6.0
-                    
-                    lambr_cost += count_hlyst * price_per_hlyst * nwin 
-                    
-    return lambr_cost
 
-def main():
-    st.set_page_config(page_title="Axis Pro GF • Калькулятор", layout="wide") 
-    
-    ensure_session_state()
+    # Заказ без панелей Ламбри/Сэндвич — прайс заполнений не трогаем
+    fills = [f for f in fills if f[0] in _LAMBR_FILLINGS]
+    if not fills:
+        return 0.0
 
-    excel = GoogleSheetsClient(GSPREAD_SHEET_ID)
+    # Хлысты (6 м) округляются вверх по каждой панели/створке отдельно,
+    # поэтому считаем столбцами, а не суммой периметров по заполнению
+    fill_names, widths, heights, nwins = zip(*fills)
+    price_per_meter = np.array([fin_calc._find_price_for_filling(f) for f in fill_names], dtype=np.float64)
+    perimeter_m = 2 * (np.array(widths, dtype=np.float64) + np.array(heights, dtype=np.float64)) / 1000.0
 
-    user = login_form(excel)
-    if not user:
-        st.stop()
+    count_hlyst = np.where(perimeter_m > 0, np.ceil(perimeter_m / 6.0), 0.0)
+    price_per_hlyst = price_per_meter * 6.0
+    costs = count_hlyst * price_per_hlyst * np.array(nwins, dtype=np.float64)
 
-    st.title("📘 Калькулятор алюминиевых изделий (Axis Pro GF)")
-    st.info(f"Пользователь: **{user['login']}**")
+    return float(costs[price_per_meter > 0].sum())
 
-    # Загружаем справочники
-    ref2_records = excel.read_records(SHEET_REF2)
+def _clean_for_set(v):
+    if v is None:
+        return None
+    s = str(v).replace("\xa0", " ").strip()
+    return s if s else None
+
+def _ref2_option_sets(records: list):
     filling_types_set = set()
     montage_types_set = set()
     handle_types_set = set()
     glass_types_set = set()
 
-    def _clean_for_set(v):
-        if v is None:
-            return None
-        s = str(v).replace("\xa0", " ").strip()
-        return s if s else None
+    if not records:
+        return filling_types_set, montage_types_set, handle_types_set, glass_types_set
+
+    # У всех строк листа одни и те же заголовки — нужные колонки находим один раз
+    keys = tuple(records[0])
+    filling_keys = [k for k in (_resolve_field_key(keys, n) for n in ("панел", "заполн", "заполнение")) if k is not None]
+    montage_key = _resolve_field_key(keys, "монтаж")
+    handle_key = _resolve_field_key(keys, "ручк")
+    glass_keys = [k for k in (_resolve_field_key(keys, n) for n in ("тип стеклопак", "тип стеклопакета")) if k is not None]
+
+    def _first(row, ks):
+        for k in ks:
+            v = row.get(k)
+            if v:
+                return v
+        return None
 
-    for row in ref2_records:
-        f = _clean_for_set(get_field(row, "панел") or get_field(row, "заполн") or get_field(row, "заполнение"))
+    for row in records:
+        f = _clean_for_set(_first(row, filling_keys))
         if f: filling_types_set.add(f)
-        m = _clean_for_set(get_field(row, "монтаж", None))
+        m = _clean_for_set(row.get(montage_key)) if montage_key is not None else None
         if m: montage_types_set.add(m)
-        h = _clean_for_set(get_field(row, "ручк", None))
+        h = _clean_for_set(row.get(handle_key)) if handle_key is not None else None
         if h: handle_types_set.add(h)
-        g = _clean_for_set(get_field(row, "тип стеклопак", None) or get_field(row, "тип стеклопакета", None))
+        g = _clean_for_set(_first(row, glass_keys))
         if g: glass_types_set.add(g)
 
-    filling_options_for_panels = sorted(list(filling_types_set))
+    return filling_types_set, montage_types_set, handle_types_set, glass_types_set
+
+# Списки выбора из СПРАВОЧНИК-2 нужны на каждом перезапуске скрипта —
+# разбираем прайс, сортируем и выбираем значения по умолчанию один раз.
+# Клиент в ключ не входит, поэтому ключ — версия справочников (data_version):
+# перечитали таблицу новым клиентом — списки собираются заново
+@st.cache_data(show_spinner=False, max_entries=8)
+def load_ref2_options(_excel: GoogleSheetsClient, data_version: int):
+    filling_types_set, montage_types_set, handle_types_set, glass_types_set = _ref2_option_sets(_excel.read_records(SHEET_REF2))
+
+    filling_options_for_panels = sorted(filling_types_set)
     if 'Стеклопакет' not in filling_options_for_panels:
         filling_options_for_panels.append('Стеклопакет')
     
@@ -1068,17 +1378,439 @@ def main():
     elif 'Ламбри без термо' in filling_options_for_panels:
         default_panel_fill_index = filling_options_for_panels.index('Ламбри без термо')
 
-    montage_options = sorted(list(montage_types_set)) if montage_types_set else ["Есть", "Нет"]
+    montage_options = sorted(montage_types_set) if montage_types_set else ["Есть", "Нет"]
     if "Нет" not in montage_options: montage_options.append("Нет")
     if "Нет" in montage_options:
         montage_options.insert(0, montage_options.pop(montage_options.index("Нет")))
 
-    handle_types = sorted(list(handle_types_set)) if handle_types_set else [""]
-    glass_types = sorted(list(glass_types_set)) if glass_types_set else ["двойной"]
+    handle_types = sorted(handle_types_set) if handle_types_set else [""]
+    glass_types = sorted(glass_types_set) if glass_types_set else ["двойной"]
     default_glass_index = 0
     if "двойной" in glass_types:
         default_glass_index = glass_types.index("двойной")
 
+    return (filling_options_for_panels, default_panel_fill_index, montage_options,
+            handle_types, glass_types, default_glass_index)
+
+# (тип изделия, профиль) -> {тип элемента: {товары}}. Пустой тип или профиль
+# в справочнике означает «подходит для любого» и хранится под ключом "".
+# Ключ кеша — версия справочников, как у load_ref2_options
+@st.cache_data(show_spinner=False, max_entries=8)
+def load_ref1_groups(_excel: GoogleSheetsClient, data_version: int):
+    index = {}
+    records = _excel.read_records(SHEET_REF1)
+    get_type = field_getter(records, "тип издел", "")
+    get_profile = field_getter(records, "система проф", "")
+    get_type_elem = field_getter(records, "тип элемент", "")
+    get_product = field_getter(records, "товар", "")
+    for row in records:
+        row_type = str(get_type(row) or "").strip()
+        row_profile = str(get_profile(row) or "").strip()
+        type_elem = str(get_type_elem(row) or "").strip()
+        product_name = str(get_product(row) or "").strip()
+        if not type_elem or not product_name:
+            continue
+
+        bucket = index.setdefault((row_type.lower(), row_profile.lower()), {})
+        bucket.setdefault(type_elem, set()).add(product_name)
+    return index
+
+def ref1_groups_for(index: dict, product_type: str, profile_system: str) -> dict:
+    pt = product_type.lower()
+    pf = profile_system.lower()
+    groups = {}
+    for key in dict.fromkeys([(pt, pf), (pt, ""), ("", pf), ("", "")]):
+        for type_elem, products in index.get(key, {}).items():
+            groups.setdefault(type_elem, set()).update(products)
+    return groups
+
+def _editor_cell(row: dict, name: str, default):
+    # Значение ячейки st.data_editor; пустая ячейка (None/NaN/"") — значение по умолчанию
+    v = row.get(name)
+    return default if v is None or pd.isna(v) or v == "" else v
+
+_PANEL_COLUMNS = {
+    "block_name": "string", "Nwin": "int64", "width_mm": "float64", "height_mm": "float64", "filling": "string",
+    "left_mm": "float64", "center_mm": "float64", "right_mm": "float64", "top_mm": "float64",
+}
+
+def _panels_frame(sections: list) -> pd.DataFrame:
+    # Таблица глухих секций из сохранённых sections_inputs — редактор Тамбура
+    # открывается с теми же панелями, что были до смены типа изделия
+    rows = [{c: s.get(c) for c in _PANEL_COLUMNS} for s in sections if s.get("kind") == "panel"]
+    return pd.DataFrame(rows, columns=list(_PANEL_COLUMNS)).astype(_PANEL_COLUMNS)
+
+# Позиций окна/двери в одном заказе — не больше, как и в прежней форме
+_MAX_POSITIONS = 10
+
+# Блок позиций перерисовывается сам по себе: правка полей не перезапускает
+# всю страницу. Результат отдаётся через session_state
+@st.fragment
+def _positions_fragment(product_type: str, glass_type: str, filling_options_for_panels: list, default_panel_fill_index: int):
+    st.header(f"Позиции ({product_type.lower()})")
+    
+    base_positions_inputs = []
+    
+    if product_type != "Тамбур":
+        is_door = product_type == "Дверь"
+        min_gabarit = 100.0
+        min_sash_gabarit = 400.0 if is_door else 200.0
+
+        # Все позиции — одна редактируемая таблица: один виджет вместо
+        # десятка полей на каждую позицию и створку
+        position_defaults = {
+            "width_mm": min_gabarit, "height_mm": min_gabarit, "Nwin": 1,
+            "door_type": "Одностворчатая",
+            "left_mm": 0.0, "center_mm": 0.0, "right_mm": 0.0, "top_mm": 0.0,
+            "n_leaves": None if is_door else 0,
+            "sash_width_mm": min_sash_gabarit, "sash_height_mm": min_sash_gabarit,
+        }
+        if not is_door:
+            del position_defaults["door_type"]
+
+        column_config = {
+            "width_mm": st.column_config.NumberColumn("Ширина изделия, мм", min_value=min_gabarit, step=10.0, default=min_gabarit, required=True),
+            "height_mm": st.column_config.NumberColumn("Высота изделия, мм", min_value=min_gabarit, step=10.0, default=min_gabarit, required=True),
+            "Nwin": st.column_config.NumberColumn("Кол-во идентичных рам (N)", min_value=1, step=1, default=1, required=True),
+            "door_type": st.column_config.SelectboxColumn("Вид изделия", options=["Одностворчатая", "Двухстворчатая"], default="Одностворчатая", required=True),
+            "left_mm": st.column_config.NumberColumn("LEFT, мм", min_value=0.0, step=10.0, default=0.0),
+            "center_mm": st.column_config.NumberColumn("CENTER, мм", min_value=0.0, step=10.0, default=0.0),
+            "right_mm": st.column_config.NumberColumn("RIGHT, мм", min_value=0.0, step=10.0, default=0.0),
+            "top_mm": st.column_config.NumberColumn("TOP, мм", min_value=0.0, step=10.0, default=0.0),
+            "n_leaves": st.column_config.NumberColumn(
+                "Кол-во створок (N_sash)", min_value=1 if is_door else 0, step=1,
+                default=None if is_door else 0,
+                help="Пусто — по виду изделия" if is_door else None,
+            ),
+            "sash_width_mm": st.column_config.NumberColumn("Ширина створки, мм", min_value=min_sash_gabarit, step=10.0, default=min_sash_gabarit),
+            "sash_height_mm": st.column_config.NumberColumn("Высота створки, мм", min_value=min_sash_gabarit, step=10.0, default=min_sash_gabarit),
+        }
+
+        # У редактора с num_rows="dynamic" данные входят в ID виджета, поэтому исходную
+        # таблицу (positions_df_<тип>) не переписываем правками — иначе следующая правка
+        # уйдёт на старый ID и потеряется. Текущие строки храним отдельно
+        # (positions_rows_<тип>) и берём их в исходную таблицу только при возврате
+        # к этому типу изделия: состояние виджета Streamlit к тому моменту уже сбросил
+        frame_key = f"positions_df_{product_type}"
+        rows_key = f"positions_rows_{product_type}"
+        if frame_key not in st.session_state or st.session_state.get("positions_shown_type") != product_type:
+            st.session_state[frame_key] = st.session_state.get(rows_key, pd.DataFrame([position_defaults]))
+
+        positions_df = st.data_editor(
+            st.session_state[frame_key],
+            column_config=column_config,
+            num_rows="dynamic",
+            hide_index=True,
+            use_container_width=True,
+            key=f"positions_{product_type}",
+        )
+        if len(positions_df) > _MAX_POSITIONS:
+            # Явная правка исходной таблицы — перерисовываем сразу, до следующей правки
+            st.session_state[frame_key] = positions_df.head(_MAX_POSITIONS).reset_index(drop=True)
+            st.session_state[rows_key] = st.session_state[frame_key]
+            st.session_state["positions_trimmed"] = True
+            st.rerun()
+        if st.session_state.pop("positions_trimmed", False):
+            st.warning(f"Не больше {_MAX_POSITIONS} позиций в заказе — лишние строки отброшены.")
+        st.session_state[rows_key] = positions_df
+
+        for row in positions_df.to_dict("records"):
+            width_mm = float(_editor_cell(row, "width_mm", min_gabarit))
+            height_mm = float(_editor_cell(row, "height_mm", min_gabarit))
+            nwin = int(_editor_cell(row, "Nwin", 1))
+            left_mm = float(_editor_cell(row, "left_mm", 0.0))
+            center_mm = float(_editor_cell(row, "center_mm", 0.0))
+            right_mm = float(_editor_cell(row, "right_mm", 0.0))
+            top_mm = float(_editor_cell(row, "top_mm", 0.0))
+
+            kind_val = "window"
+            default_leaves_count = 0
+            if is_door:
+                kind_val = "door"
+                door_type = _editor_cell(row, "door_type", "Одностворчатая")
+                default_leaves_count = 1 if door_type == "Одностворчатая" else 2
+            n_leaves = int(_editor_cell(row, "n_leaves", default_leaves_count))
+
+            # Размер створки задаётся один на позицию. Габариты и материалы считаются по
+            # первой створке, а стеклопакет створок окна/двери в ламбри не попадает, поэтому
+            # отдельные размеры остальных створок на расчёт не влияли
+            sash_width_mm = float(_editor_cell(row, "sash_width_mm", min_sash_gabarit))
+            sash_height_mm = float(_editor_cell(row, "sash_height_mm", min_sash_gabarit))
+            leaves_data = [
+                {"width_mm": sash_width_mm, "height_mm": sash_height_mm, "filling": glass_type}
+                for _ in range(max(n_leaves, 0))
+            ]
+
+            first_sash_w = leaves_data[0]['width_mm'] if leaves_data else 0.0
+            first_sash_h = leaves_data[0]['height_mm'] if leaves_data else 0.0
+            
+            if kind_val == "door":
+                data_to_append = {
+                    "frame_width_mm": width_mm, "frame_height_mm": height_mm,
+                    "width_mm": width_mm, "height_mm": height_mm,
+                    "left_mm": left_mm, "center_mm": center_mm, "right_mm": right_mm, "top_mm": top_mm,
+                    "sash_width_mm": first_sash_w, "sash_height_mm": first_sash_h,
+                    "Nwin": nwin, "filling": glass_type,
+                    "kind": kind_val,
+                    "n_leaves": n_leaves, "leaves": leaves_data 
+                }
+            else:
+                data_to_append = {
+                    "width_mm": width_mm, "height_mm": height_mm,
+                    "left_mm": left_mm, "center_mm": center_mm, "right_mm": right_mm, "top_mm": top_mm,
+                    "sash_width_mm": first_sash_w, "sash_height_mm": first_sash_h,
+                    "Nwin": nwin, "filling": glass_type,
+                    "kind": kind_val,
+                    "n_leaves": n_leaves, "leaves": leaves_data 
+                }
+
+            base_positions_inputs.append(data_to_append)
+    else:
+        # Динамический блок для Тамбура
+        st.header("Параметры тамбура (дверные блоки и глухие панели)")
+
+        c_add = st.columns([1,1,6])
+        if c_add[0].button("Добавить дверной блок"): st.session_state["tam_door_count"] += 1
+        add_panel = c_add[1].button("Добавить глухую секцию")
+        
+        current_sections = st.session_state.get("sections_inputs", [])
+        # id секции -> её место в списке: поиск и обновление блока без прохода по списку
+        sections_index = {s.get("id"): j for j, s in enumerate(current_sections)}
+        st.markdown("---")
+        st.markdown("**Управление текущими секциями:**")
+        sections_to_remove = []
+        
+        # Дверные блоки
+        for i in range(st.session_state.get("tam_door_count", 0)):
+            existing_idx = sections_index.get(f"door_{i}")
+            existing_section = current_sections[existing_idx] if existing_idx is not None else None
+            
+            with st.expander(f"🚪 Дверной блок #{i+1}", expanded=False):
+                name = st.text_input(f"Название блока #{i+1}", value=existing_section.get("block_name", f"Дверной блок {i+1}") if existing_section else f"Дверной блок {i+1}", key=f"door_name_{i}")
+                count = st.number_input(f"Кол-во одинаковых блоков #{i+1}", min_value=1, value=existing_section.get("Nwin", 1) if existing_section else 1, key=f"door_count_{i}")
+                dtype = st.selectbox(f"Тип двери #{i+1}", ["Одностворчатая","Двухстворчатая"], index=0, key=f"door_type_{i}")
+                
+                min_gabarit = 100.0
+                frame_w = st.number_input(f"Ширина рамы (изделия), мм #{i+1}", min_value=min_gabarit, step=10.0, value=existing_section.get("frame_width_mm", min_gabarit) if existing_section else min_gabarit, key=f"frame_w_{i}")
+                frame_h = st.number_input(f"Высота рамы (изделия), мм #{i+1}", min_value=min_gabarit, step=10.0, value=existing_section.get("frame_height_mm", min_gabarit) if existing_section else min_gabarit, key=f"frame_h_{i}")
+                
+                st.subheader("Внутренние импосты (для деления рамы)")
+                c_imp1, c_imp2 = st.columns(2)
+                left = c_imp1.number_input(f"LEFT, мм #{i+1} (ДБ)", min_value=0.0, step=10.0, value=existing_section.get("left_mm", 0.0) if existing_section else 0.0, key=f"left_{i}")
+                center = c_imp2.number_input(f"CENTER, мм #{i+1} (ДБ)", min_value=0.0, step=10.0, value=existing_section.get("center_mm", 0.0) if existing_section else 0.0, key=f"center_{i}")
+                c_imp3, c_imp4 = st.columns(2)
+                right = c_imp3.number_input(f"RIGHT, мм #{i+1} (ДБ)", min_value=0.0, step=10.0, value=existing_section.get("right_mm", 0.0) if existing_section else 0.0, key=f"right_{i}")
+                top = c_imp4.number_input(f"TOP, мм #{i+1} (ДБ)", min_value=0.0, step=10.0, value=existing_section.get("top_mm", 0.0) if existing_section else 0.0, key=f"top_{i}")
+
+                default_leaves = 1 if dtype == "Одностворчатая" else 2
+                n_leaves_val = existing_section.get("n_leaves", default_leaves) if existing_section else default_leaves
+                n_leaves = st.number_input(f"Кол-во створок #{i+1}", min_value=1, value=n_leaves_val, key=f"n_leaves_{i}")
+
+                leaves = []
+                for L in range(int(n_leaves)):
+                    st.markdown(f"**Створка {L+1}**")
+                    existing_leaf = existing_section.get("leaves", [{}])[L] if existing_section and L < len(existing_section.get("leaves", [])) else {}
+                    
+                    min_sash_gabarit = 400.0
+                    lw = st.number_input(f"Ширина створки {L+1} (мм) — блок {i+1}", min_value=min_sash_gabarit, step=10.0, value=existing_leaf.get("width_mm", min_sash_gabarit), key=f"leaf_w_{i}_{L}")
+                    lh = st.number_input(f"Высота створки {L+1} (мм) — блок {i+1}", min_value=min_sash_gabarit, step=10.0, value=existing_leaf.get("height_mm", min_sash_gabarit), key=f"leaf_h_{i}_{L}")
+                    
+                    default_fill_idx = filling_options_for_panels.index(existing_leaf.get("filling", glass_type)) if existing_leaf.get("filling") in filling_options_for_panels else (filling_options_for_panels.index(glass_type) if glass_type in filling_options_for_panels else 0)
+                    fill = st.selectbox(f"Заполнение створки {L+1} — блок {i+1}", options=filling_options_for_panels, index=default_fill_idx, key=f"leaf_fill_{i}_{L}")
+                    leaves.append({"width_mm": lw, "height_mm": lh, "filling": fill})
+                    
+                c_save, c_del = st.columns(2)
+                if c_save.button(f"✅ Обновить ДБ #{i+1}", key=f"save_door_{i}"):
+                    new_section = {
+                        "id": f"door_{i}",
+                        "kind": "door",
+                        "block_name": name,
+                        "frame_width_mm": frame_w, "frame_height_mm": frame_h,
+                        "left_mm": left, "center_mm": center, "right_mm": right, "top_mm": top, 
+                        "n_leaves": int(n_leaves), "leaves": leaves,
+                        "Nwin": int(count), "filling": glass_type 
+                    }
+                    if existing_idx is None:
+                        current_sections.append(new_section)
+                    else:
+                        current_sections[existing_idx] = new_section
+                    st.session_state["sections_inputs"] = current_sections
+                    st.success(f"Дверной блок '{name}' добавлен/обновлён.")
+                    st.rerun()
+                
+                if c_del.button(f"❌ Удалить ДБ #{i+1}", key=f"del_door_{i}"):
+                    sections_to_remove.append(f"door_{i}")
+
+        # Глухие секции (панели) — одна редактируемая таблица: строка = секция.
+        # Секции из таблицы сразу попадают в расчёт, кнопки сохранения не нужны
+        st.markdown("**Глухие секции (панели):**")
+        default_panel_fill = filling_options_for_panels[default_panel_fill_index]
+        min_gabarit = 100.0
+        # Исходная таблица редактора меняется только явно — при возврате к Тамбуру
+        # (из сохранённых секций) и кнопкой добавления: данные входят в ID виджета
+        # (num_rows="dynamic"), и перезапись после каждой правки теряла бы следующую
+        if "tam_panels_df" not in st.session_state or st.session_state.get("positions_shown_type") != "Тамбур":
+            st.session_state["tam_panels_df"] = _panels_frame(current_sections)
+
+        panels_df = st.data_editor(
+            st.session_state["tam_panels_df"],
+            column_config={
+                "block_name": st.column_config.TextColumn("Название панели", help="Пусто — «Панель N»"),
+                "Nwin": st.column_config.NumberColumn("Кол-во одинаковых панелей", min_value=1, step=1, default=1, required=True),
+                "width_mm": st.column_config.NumberColumn("Ширина панели, мм", min_value=min_gabarit, step=10.0, default=min_gabarit, required=True),
+                "height_mm": st.column_config.NumberColumn("Высота панели, мм", min_value=min_gabarit, step=10.0, default=min_gabarit, required=True),
+                "filling": st.column_config.SelectboxColumn("Заполнение панели", options=filling_options_for_panels, default=default_panel_fill, required=True),
+                "left_mm": st.column_config.NumberColumn("LEFT, мм", min_value=0.0, step=10.0, default=0.0),
+                "center_mm": st.column_config.NumberColumn("CENTER, мм", min_value=0.0, step=10.0, default=0.0),
+                "right_mm": st.column_config.NumberColumn("RIGHT, мм", min_value=0.0, step=10.0, default=0.0),
+                "top_mm": st.column_config.NumberColumn("TOP, мм", min_value=0.0, step=10.0, default=0.0),
+            },
+            num_rows="dynamic",
+            hide_index=True,
+            use_container_width=True,
+            key="tam_panels",
+        )
+
+        panel_sections = []
+        for i, row in enumerate(panels_df.to_dict("records")):
+            panel_sections.append({
+                "id": f"panel_{i}",
+                "kind": "panel", "block_name": str(_editor_cell(row, "block_name", f"Панель {i+1}")),
+                "width_mm": float(_editor_cell(row, "width_mm", min_gabarit)), "height_mm": float(_editor_cell(row, "height_mm", min_gabarit)),
+                "left_mm": float(_editor_cell(row, "left_mm", 0.0)), "center_mm": float(_editor_cell(row, "center_mm", 0.0)),
+                "right_mm": float(_editor_cell(row, "right_mm", 0.0)), "top_mm": float(_editor_cell(row, "top_mm", 0.0)),
+                "filling": _editor_cell(row, "filling", default_panel_fill), "Nwin": int(_editor_cell(row, "Nwin", 1))
+            })
+        st.session_state["sections_inputs"] = [s for s in st.session_state["sections_inputs"] if s.get("kind") != "panel"] + panel_sections
+
+        if add_panel:
+            # Новая строка дописывается к текущим строкам редактора вместе с их правками;
+            # таблица сменилась — перерисовываем сразу, до следующей правки
+            new_panel = {"Nwin": 1, "width_mm": min_gabarit, "height_mm": min_gabarit, "filling": default_panel_fill,
+                         "left_mm": 0.0, "center_mm": 0.0, "right_mm": 0.0, "top_mm": 0.0}
+            st.session_state["tam_panels_df"] = pd.concat(
+                [panels_df, pd.DataFrame([new_panel], columns=list(_PANEL_COLUMNS)).astype(_PANEL_COLUMNS)],
+                ignore_index=True,
+            )
+            st.rerun()
+
+        # Удаление секций после цикла
+        if sections_to_remove:
+            st.session_state["sections_inputs"] = [s for s in st.session_state["sections_inputs"] if s.get("id") not in sections_to_remove]
+            st.session_state["tam_door_count"] = len([s for s in st.session_state["sections_inputs"] if s.get("kind") == "door"])
+            st.info(f"Удалены {len(sections_to_remove)} секций. Перезагрузка...")
+            st.rerun()
+        
+        st.markdown("**Текущие секции Тамбура:**")
+        if st.session_state["sections_inputs"]:
+            for idx, s in enumerate(st.session_state["sections_inputs"], start=1):
+                main_dim = f"{s.get('width_mm', s.get('frame_width_mm'))}x{s.get('height_mm', s.get('frame_height_mm'))}"
+                imposts = f" L{s.get('left_mm',0)} C{s.get('center_mm',0)} R{s.get('right_mm',0)} T{s.get('top_mm',0)}"
+                st.write(f"**{idx}. {s.get('kind').capitalize()}** ({s.get('block_name')}) — {main_dim}, N={s.get('Nwin',1)} | Заполнение: {s.get('filling', glass_type)} | Импосты:{imposts}")
+        else:
+            st.info("Нет добавленных секций.")
+        
+    st.markdown("---")
+
+    st.session_state["base_positions_inputs"] = base_positions_inputs
+    st.session_state["positions_shown_type"] = product_type
+
+@st.fragment
+def _duplicates_fragment(excel: GoogleSheetsClient, product_type: str, profile_system: str):
+    st.header("🧾 Выбор материалов при дублях")
+    selected_duplicates = {}
+
+    groups = ref1_groups_for(load_ref1_groups(excel, excel.data_version), product_type, profile_system)
+
+    if not groups:
+        st.info("Для выбранного типа изделия и профиля дублей материалов не найдено.")
+    else:
+        for type_elem, products in sorted(groups.items(), key=lambda kv: kv[0]):
+            if len(products) <= 1:
+                continue
+            sorted_products = sorted(products)
+            chosen = st.multiselect(
+                f"Тип элемента: {type_elem}",
+                options=sorted_products,
+                default=sorted_products,
+                key=f"dup_{type_elem}"
+            )
+            selected_duplicates[type_elem] = set(chosen)
+
+    st.session_state["selected_duplicates"] = selected_duplicates
+
+# Расчёт зависит только от данных заказа и справочников: повторное нажатие с теми же
+# данными берёт результат из кеша. Своего ttl нет — ключ включает версию справочников
+# (data_version клиента), и с новым клиентом старые результаты больше не подходят.
+# Здесь только чистый расчёт: листы результатов пишет _write_result_sheets на каждое нажатие
+@st.cache_data(show_spinner=False, max_entries=32)
+def _run_calculation(_excel: GoogleSheetsClient, data_version: int, sections: list, selected_duplicates: dict,
+                     product_type: str, profile_system: str, glass_type: str, toning: str,
+                     assembly: str, montage: str, handle_type: str, door_closer: str):
+    # --- Gabarit Calculation ---
+    gab_calc = GabaritCalculator(_excel)
+    gab_calc_order_data = {"product_type": product_type}
+    gabarit_rows, total_area_gab, total_perimeter_gab = gab_calc.calculate(gab_calc_order_data, sections)
+
+    # --- Material Calculation ---
+    mat_calc = MaterialCalculator(_excel)
+    mat_calc_order_data = {"product_type": product_type, "profile_system": profile_system}
+    selected_duplicates = {k: set(v) for k, v in selected_duplicates.items()}
+    material_rows, material_total, total_area_mat = mat_calc.calculate(mat_calc_order_data, sections, selected_duplicates)
+    
+    # --- Intermediate Sums for FinalCalc ---
+    total_area_all = total_area_gab
+
+    fin_calc = FinalCalculator(_excel)
+    lambr_cost = _calculate_lambr_cost(sections, fin_calc)
+
+    # --- Handles / Door Closer Counts ---
+    # Каждый дверной блок — одна запись; ручки и доводчики считаются по числу блоков
+    handles_count = 0
+    closer_count = 0
+    if product_type == "Дверь" or product_type == "Тамбур":
+        handles_count = sum(s.get("Nwin", 1) for s in sections if s.get("kind") == "door")
+        if door_closer.lower() == "есть":
+            closer_count = handles_count
+                    
+    # --- Final Calculation ---
+    final_calc_order_data = {
+        "product_type": product_type, "glass_type": glass_type, "toning": toning,
+        "assembly": assembly, "montage": montage, "handle_type": handle_type, "door_closer": door_closer
+    }
+    final_rows, total_sum, ensure_sum = fin_calc.calculate(
+        final_calc_order_data,
+        total_area_all=total_area_all, material_total=material_total,
+        lambr_cost=lambr_cost, handles_qty=handles_count, closer_qty=closer_count
+    )
+
+    return (gabarit_rows, total_area_gab, total_perimeter_gab, material_rows, material_total,
+            lambr_cost, final_rows, total_sum, ensure_sum)
+
+def _write_result_sheets(excel: GoogleSheetsClient, gabarit_rows: list, material_rows: list,
+                         final_rows: list, total_sum: float):
+    excel.clear_and_write(SHEET_GABARITS, GabaritCalculator.HEADER, gabarit_rows)
+    excel.clear_and_write(SHEET_MATERIAL, MaterialCalculator.HEADER, material_rows)
+    excel.clear_and_write(SHEET_FINAL, FinalCalculator.HEADER, final_rows + [["ИТОГО", "", "", total_sum]])
+
+def main():
+    st.set_page_config(page_title="Axis Pro GF • Калькулятор", layout="wide") 
+    
+    ensure_session_state()
+
+    excel = get_sheets_client(GSPREAD_SHEET_ID)
+
+    user = login_form(excel)
+    if not user:
+        st.stop()
+
+    st.title("📘 Калькулятор алюминиевых изделий (Axis Pro GF)")
+    st.info(f"Пользователь: **{user['login']}**")
+
+    # Загружаем справочники
+    (filling_options_for_panels, default_panel_fill_index, montage_options,
+     handle_types, glass_types, default_glass_index) = load_ref2_options(excel, excel.data_version)
+
 
     # ---------- Sidebar: общие данные ----------
     with st.sidebar:
@@ -1097,264 +1829,18 @@ def main():
     col_left, col_right = st.columns([2, 1])
 
     with col_left:
-        st.header(f"Позиции ({product_type.lower()})")
-        
-        base_positions_inputs = []
-        
-        if product_type != "Тамбур":
-            positions_count = st.number_input("Количество позиций", min_value=1, max_value=10, value=st.session_state.get('pos_count', 1), step=1, key='pos_count')
-            
-            for i in range(int(positions_count)):
-                st.subheader(f"Позиция {i+1}")
-                
-                # Поля габаритов рамы/изделия
-                st.markdown("**Габариты рамы/изделия**")
-                c1, c2, c_nwin = st.columns(3)
-                
-                min_gabarit = 100.0 if product_type == "Дверь" else 100.0
-                
-                width_mm = c1.number_input(f"Ширина изделия, мм (поз. {i+1})", min_value=min_gabarit, step=10.0, key=f"w_{i}")
-                height_mm = c2.number_input(f"Высота изделия, мм (поз. {i+1})", min_value=min_gabarit, step=10.0, key=f"h_{i}")
-                nwin = c_nwin.number_input(f"Кол-во идентичных рам (N) (поз. {i+1})", min_value=1, value=1, step=1, key=f"nwin_{i}")
-                
-                # Выбор типа створки/двери
-                kind_val = "window"
-                default_leaves_count = 0
-                if product_type == "Дверь":
-                    kind_val = "door"
-                    st.markdown("**Тип дверного полотна**")
-                    door_type = st.selectbox(f"Вид изделия (поз. {i+1})", ["Одностворчатая", "Двухстворчатая"], key=f"dtype_{i}")
-                    default_leaves_count = 1 if door_type == "Одностворчатая" else 2
-                
-                # Размеры импостов
-                st.markdown("**Размеры импостов (для деления)**")
-                c_l, c_c, c_r, c_t = st.columns(4)
-                left_mm = c_l.number_input(f"LEFT, мм (поз. {i+1})", min_value=0.0, step=10.0, value=0.0, key=f"l_{i}")
-                center_mm = c_c.number_input(f"CENTER, мм (поз. {i+1})", min_value=0.0, step=10.0, value=0.0, key=f"c_{i}")
-                right_mm = c_r.number_input(f"RIGHT, мм (поз. {i+1})", min_value=0.0, step=10.0, value=0.0, key=f"r_{i}")
-                top_mm = c_t.number_input(f"TOP, мм (поз. {i+1})", min_value=0.0, step=10.0, value=0.0, key=f"t_{i}")
-                
-                # Створки и фурнитура
-                st.markdown("**Створки и фурнитура**")
-                
-                if kind_val == "door":
-                     n_leaves = st.number_input(f"Общее количество створок (N_sash) (поз. {i+1})", min_value=1, value=default_leaves_count, step=1, key=f"nleaves_{i}")
-                else:
-                     n_leaves = st.number_input(f"Общее количество створок (N_sash) (поз. {i+1})", min_value=0, value=default_leaves_count, step=1, key=f"nleaves_{i}")
-
-
-                leaves_data = []
-                if n_leaves > 0:
-                    for L in range(int(n_leaves)):
-                        st.markdown(f"**Размеры створки {L+1}**")
-                        c_sash_w, c_sash_h = st.columns(2)
-                        
-                        min_sash_gabarit = 400.0 if product_type == "Дверь" else 200.0
-                        
-                        sash_width_mm = c_sash_w.number_input(f"Ширина створки {L+1}, мм (поз. {i+1})", min_value=min_sash_gabarit, step=10.0, key=f"sw_{i}_{L}")
-                        sash_height_mm = c_sash_h.number_input(f"Высота створки {L+1}, мм (поз. {i+1})", min_value=min_sash_gabarit, step=10.0, key=f"sh_{i}_{L}")
-                        
-                        leaves_data.append({
-                            "width_mm": sash_width_mm, 
-                            "height_mm": sash_height_mm,
-                            "filling": glass_type 
-                        })
-
-                first_sash_w = leaves_data[0]['width_mm'] if leaves_data else 0.0
-                first_sash_h = leaves_data[0]['height_mm'] if leaves_data else 0.0
-                
-                if kind_val == "door":
-                    data_to_append = {
-                        "frame_width_mm": width_mm, "frame_height_mm": height_mm,
-                        "width_mm": width_mm, "height_mm": height_mm,
-                        "left_mm": left_mm, "center_mm": center_mm, "right_mm": right_mm, "top_mm": top_mm,
-                        "sash_width_mm": first_sash_w, "sash_height_mm": first_sash_h,
-                        "Nwin": nwin, "filling": glass_type,
-                        "kind": kind_val,
-                        "n_leaves": n_leaves, "leaves": leaves_data 
-                    }
-                else:
-                    data_to_append = {
-                        "width_mm": width_mm, "height_mm": height_mm,
-                        "left_mm": left_mm, "center_mm": center_mm, "right_mm": right_mm, "top_mm": top_mm,
-                        "sash_width_mm": first_sash_w, "sash_height_mm": first_sash_h,
-                        "Nwin": nwin, "filling": glass_type,
-                        "kind": kind_val,
-                        "n_leaves": n_leaves, "leaves": leaves_data 
-                    }
-
-                base_positions_inputs.append(data_to_append)
-        else:
-            # Динамический блок для Тамбура
-            st.header("Параметры тамбура (дверные блоки и глухие панели)")
-
-            c_add = st.columns([1,1,6])
-            if c_add[0].button("Добавить дверной блок"): st.session_state["tam_door_count"] += 1
-            if c_add[1].button("Добавить глухую секцию"): st.session_state["tam_panel_count"] += 1
-            
-            current_sections = st.session_state.get("sections_inputs", [])
-            st.markdown("---")
-            st.markdown("**Управление текущими секциями:**")
-            sections_to_remove = []
-            
-            # Дверные блоки
-            for i in range(st.session_state.get("tam_door_count", 0)):
-                existing_section = next((s for s in current_sections if s.get("id") == f"door_{i}"), None)
-                
-                with st.expander(f"🚪 Дверной блок #{i+1}", expanded=False):
-                    name = st.text_input(f"Название блока #{i+1}", value=existing_section.get("block_name", f"Дверной блок {i+1}") if existing_section else f"Дверной блок {i+1}", key=f"door_name_{i}")
-                    count = st.number_input(f"Кол-во одинаковых блоков #{i+1}", min_value=1, value=existing_section.get("Nwin", 1) if existing_section else 1, key=f"door_count_{i}")
-                    dtype = st.selectbox(f"Тип двери #{i+1}", ["Одностворчатая","Двухстворчатая"], index=0, key=f"door_type_{i}")
-                    
-                    min_gabarit = 100.0
-                    frame_w = st.number_input(f"Ширина рамы (изделия), мм #{i+1}", min_value=min_gabarit, step=10.0, value=existing_section.get("frame_width_mm", min_gabarit) if existing_section else min_gabarit, key=f"frame_w_{i}")
-                    frame_h = st.number_input(f"Высота рамы (изделия), мм #{i+1}", min_value=min_gabarit, step=10.0, value=existing_section.get("frame_height_mm", min_gabarit) if existing_section else min_gabarit, key=f"frame_h_{i}")
-                    
-                    st.subheader("Внутренние импосты (для деления рамы)")
-                    c_imp1, c_imp2 = st.columns(2)
-                    left = c_imp1.number_input(f"LEFT, мм #{i+1} (ДБ)", min_value=0.0, step=10.0, value=existing_section.get("left_mm", 0.0) if existing_section else 0.0, key=f"left_{i}")
-                    center = c_imp2.number_input(f"CENTER, мм #{i+1} (ДБ)", min_value=0.0, step=10.0, value=existing_section.get("center_mm", 0.0) if existing_section else 0.0, key=f"center_{i}")
-                    c_imp3, c_imp4 = st.columns(2)
-                    right = c_imp3.number_input(f"RIGHT, мм #{i+1} (ДБ)", min_value=0.0, step=10.0, value=existing_section.get("right_mm", 0.0) if existing_section else 0.0, key=f"right_{i}")
-                    top = c_imp4.number_input(f"TOP, мм #{i+1} (ДБ)", min_value=0.0, step=10.0, value=existing_section.get("top_mm", 0.0) if existing_section else 0.0, key=f"top_{i}")
-
-                    default_leaves = 1 if dtype == "Одностворчатая" else 2
-                    n_leaves_val = existing_section.get("n_leaves", default_leaves) if existing_section else default_leaves
-                    n_leaves = st.number_input(f"Кол-во створок #{i+1}", min_value=1, value=n_leaves_val, key=f"n_leaves_{i}")
-
-                    leaves = []
-                    for L in range(int(n_leaves)):
-                        st.markdown(f"**Створка {L+1}**")
-                        existing_leaf = existing_section.get("leaves", [{}])[L] if existing_section and L < len(existing_section.get("leaves", [])) else {}
-                        
-                        min_sash_gabarit = 400.0
-                        lw = st.number_input(f"Ширина створки {L+1} (мм) — блок {i+1}", min_value=min_sash_gabarit, step=10.0, value=existing_leaf.get("width_mm", min_sash_gabarit), key=f"leaf_w_{i}_{L}")
-                        lh = st.number_input(f"Высота створки {L+1} (мм) — блок {i+1}", min_value=min_sash_gabarit, step=10.0, value=existing_leaf.get("height_mm", min_sash_gabarit), key=f"leaf_h_{i}_{L}")
-                        
-                        default_fill_idx = filling_options_for_panels.index(existing_leaf.get("filling", glass_type)) if existing_leaf.get("filling") in filling_options_for_panels else (filling_options_for_panels.index(glass_type) if glass_type in filling_options_for_panels else 0)
-                        fill = st.selectbox(f"Заполнение створки {L+1} — блок {i+1}", options=filling_options_for_panels, index=default_fill_idx, key=f"leaf_fill_{i}_{L}")
-                        leaves.append({"width_mm": lw, "height_mm": lh, "filling": fill})
-                        
-                    c_save, c_del = st.columns(2)
-                    if c_save.button(f"✅ Обновить ДБ #{i+1}", key=f"save_door_{i}"):
-                        new_section = {
-                            "id": f"door_{i}",
-                            "kind": "door",
-                            "block_name": name,
-                            "frame_width_mm": frame_w, "frame_height_mm": frame_h,
-                            "left_mm": left, "center_mm": center, "right_mm": right, "top_mm": top, 
-                            "n_leaves": int(n_leaves), "leaves": leaves,
-                            "Nwin": int(count), "filling": glass_type 
-                        }
-                        st.session_state["sections_inputs"] = [s for s in st.session_state["sections_inputs"] if not (s.get("id") == f"door_{i}")]
-                        st.session_state["sections_inputs"].append(new_section)
-                        st.success(f"Дверной блок '{name}' добавлен/обновлён.")
-                        st.rerun()
-                    
-                    if c_del.button(f"❌ Удалить ДБ #{i+1}", key=f"del_door_{i}"):
-                        sections_to_remove.append(f"door_{i}")
-
-            # Глухие секции (панели)
-            for i in range(st.session_state.get("tam_panel_count", 0)):
-                existing_section = next((s for s in current_sections if s.get("id") == f"panel_{i}"), None)
-                
-                with st.expander(f"🔲 Глухая секция #{i+1}", expanded=False):
-                    name = st.text_input(f"Название панели #{i+1}", value=existing_section.get("block_name", f"Панель {i+1}") if existing_section else f"Панель {i+1}", key=f"panel_name_{i}")
-                    count = st.number_input(f"Кол-во одинаковых панелей #{i+1}", min_value=1, value=existing_section.get("Nwin", 1) if existing_section else 1, key=f"panel_count_{i}")
-                    p1, p2 = st.columns(2)
-                    
-                    min_gabarit = 100.0
-                    w = p1.number_input(f"Ширина панели, мм #{i+1}", min_value=min_gabarit, step=10.0, value=existing_section.get("width_mm", min_gabarit) if existing_section else min_gabarit, key=f"panel_w_{i}")
-                    h = p2.number_input(f"Высота панели, мм #{i+1}", min_value=min_gabarit, step=10.0, value=existing_section.get("height_mm", min_gabarit) if existing_section else min_gabarit, key=f"panel_h_{i}")
-                    
-                    default_fill_idx = filling_options_for_panels.index(existing_section.get("filling", filling_options_for_panels[default_panel_fill_index])) if existing_section and existing_section.get("filling") in filling_options_for_panels else default_panel_fill_index
-                    fill = st.selectbox(f"Заполнение панели #{i+1}", options=filling_options_for_panels, index=default_fill_idx, key=f"panel_fill_{i}")
-                    
-                    st.subheader("Внутренние импосты (для деления рамы)")
-                    c_imp5, c_imp6 = st.columns(2)
-                    left = c_imp5.number_input(f"LEFT, мм #{i+1} (ГС)", min_value=0.0, step=10.0, value=existing_section.get("left_mm", 0.0) if existing_section else 0.0, key=f"panel_left_{i}")
-                    center = c_imp6.number_input(f"CENTER, мм #{i+1} (ГС)", min_value=0.0, step=10.0, value=existing_section.get("center_mm", 0.0) if existing_section else 0.0, key=f"panel_center_{i}")
-                    c_imp7, c_imp8 = st.columns(2)
-                    right = c_imp7.number_input(f"RIGHT, мм #{i+1} (ГС)", min_value=0.0, step=10.0, value=existing_section.get("right_mm", 0.0) if existing_section else 0.0, key=f"panel_right_{i}")
-                    top = c_imp8.number_input(f"TOP, мм #{i+1} (ГС)", min_value=0.0, step=10.0, value=existing_section.get("top_mm", 0.0) if existing_section else 0.0, key=f"panel_top_{i}")
-
-                    c_save, c_del = st.columns(2)
-                    if c_save.button(f"✅ Обновить Панель #{i+1}", key=f"save_panel_{i}"):
-                        new_section = {
-                            "id": f"panel_{i}", 
-                            "kind": "panel", "block_name": name,
-                            "width_mm": w, "height_mm": h,
-                            "left_mm": left, "center_mm": center, "right_mm": right, "top_mm": top, 
-                            "filling": fill, "Nwin": int(count)
-                        }
-                        st.session_state["sections_inputs"] = [s for s in st.session_state["sections_inputs"] if not (s.get("id") == f"panel_{i}")]
-                        st.session_state["sections_inputs"].append(new_section)
-                        st.success(f"Панель '{name}' добавлена/обновлена.")
-                        st.rerun()
-                        
-                    if c_del.button(f"❌ Удалить Панель #{i+1}", key=f"del_panel_{i}"):
-                        sections_to_remove.append(f"panel_{i}")
-                        
-            # Удаление секций после цикла
-            if sections_to_remove:
-                st.session_state["sections_inputs"] = [s for s in st.session_state["sections_inputs"] if s.get("id") not in sections_to_remove]
-                st.session_state["tam_door_count"] = len([s for s in st.session_state["sections_inputs"] if s.get("kind") == "door"])
-                st.session_state["tam_panel_count"] = len([s for s in st.session_state["sections_inputs"] if s.get("kind") == "panel"])
-                st.info(f"Удалены {len(sections_to_remove)} секций. Перезагрузка...")
-                st.rerun()
-            
-            st.markdown("**Текущие секции Тамбура:**")
-            if st.session_state["sections_inputs"]:
-                for idx, s in enumerate(st.session_state["sections_inputs"], start=1):
-                    main_dim = f"{s.get('width_mm', s.get('frame_width_mm'))}x{s.get('height_mm', s.get('frame_height_mm'))}"
-                    imposts = f" L{s.get('left_mm',0)} C{s.get('center_mm',0)} R{s.get('right_mm',0)} T{s.get('top_mm',0)}"
-                    st.write(f"**{idx}. {s.get('kind').capitalize()}** ({s.get('block_name')}) — {main_dim}, N={s.get('Nwin',1)} | Заполнение: {s.get('filling', glass_type)} | Импосты:{imposts}")
-            else:
-                st.info("Нет добавленных секций.")
-            
-        st.markdown("---")
+        _positions_fragment(product_type, glass_type, filling_options_for_panels, default_panel_fill_index)
 
     with col_right:
         st.header("Информация")
         st.info("Данные справочников кешируются на 1 час для ускорения работы.")
         st.info("Обратите внимание на логику расчета стоимости панелей (Ламбри/Сэндвич): предполагается, что цена указана за м/п 6-метрового хлыста.")
-        
-        # ---------- Выбор материалов при дублях ----------
-        st.header("🧾 Выбор материалов при дублях")
-        selected_duplicates = {}
 
-        ref1 = excel.read_records(SHEET_REF1)
-        groups = {}
-        for row in ref1:
-            row_type = str(get_field(row, "тип издел", "") or "").strip()
-            row_profile = str(get_field(row, "система проф", "") or "").strip()
-
-            if row_type and row_type.lower() != product_type.lower():
-                continue
-            if row_profile and row_profile.lower() != profile_system.lower():
-                continue
-
-            type_elem = str(get_field(row, "тип элемент", "") or "").strip()
-            product_name = str(get_field(row, "товар", "") or "").strip()
-            if not type_elem or not product_name:
-                continue
-
-            groups.setdefault(type_elem, set()).add(product_name)
+        # ---------- Выбор материалов при дублях ----------
+        _duplicates_fragment(excel, product_type, profile_system)
 
-        if not groups:
-            st.info("Для выбранного типа изделия и профиля дублей материалов не найдено.")
-        else:
-            for type_elem, products in sorted(groups.items(), key=lambda kv: kv[0]):
-                if len(products) <= 1:
-                    continue
-                default = sorted(list(products))
-                chosen = st.multiselect(
-                    f"Тип элемента: {type_elem}",
-                    options=sorted(list(products)),
-                    default=default,
-                    key=f"dup_{type_elem}"
-                )
-                selected_duplicates[type_elem] = set(chosen)
+    base_positions_inputs = st.session_state.get("base_positions_inputs", [])
+    selected_duplicates = st.session_state.get("selected_duplicates", {})
 
     # ---------- Кнопка расчёта ----------
     st.markdown("---")
@@ -1376,61 +1862,34 @@ def main():
             st.error("Необходимо задать хотя бы одну позицию/секцию.")
             st.stop()
             
-        # Валидация габаритов и расчет площади/периметра
-        valid_sections = []
-        for p in sections:
-            w_val = p.get("width_mm", 0.0) if p.get("kind") == "window" or p.get("kind") == "panel" else p.get("frame_width_mm", 0.0)
-            h_val = p.get("height_mm", 0.0) if p.get("kind") == "window" or p.get("kind") == "panel" else p.get("frame_height_mm", 0.0)
-            
-            section_name = p.get('block_name', f"позиция №{sections.index(p) + 1} ({p.get('kind').capitalize()})")
-            
-            if w_val <= 0 or h_val <= 0:
-                st.error(f"❌ Секция/позиция '{section_name}' имеет нулевую или отрицательную ширину ({w_val} мм) или высоту ({h_val} мм). Исправьте в разделе '{product_type}'.")
-                st.stop()
-            
-            area_m2 = (w_val * h_val) / 1_000_000.0
-            perimeter_m = 2 * (w_val + h_val) / 1000.0
-            valid_sections.append({**p, "area_m2": area_m2, "perimeter_m": perimeter_m})
-            
-        sections = valid_sections
-            
-        # --- Gabarit Calculation ---
-        gab_calc = GabaritCalculator(excel)
-        gab_calc_order_data = {"product_type": product_type}
-        gabarit_rows, total_area_gab, total_perimeter_gab = gab_calc.calculate(gab_calc_order_data, sections)
-
-        # --- Material Calculation ---
-        mat_calc = MaterialCalculator(excel)
-        mat_calc_order_data = {"product_type": product_type, "profile_system": profile_system}
-        material_rows, material_total, total_area_mat = mat_calc.calculate(mat_calc_order_data, sections, selected_duplicates)
-        
-        # --- Intermediate Sums for FinalCalc ---
-        total_area_all = total_area_gab
-
-        fin_calc = FinalCalculator(excel)
-        lambr_cost = _calculate_lambr_cost(sections, fin_calc)
+        # Валидация габаритов и расчет площади/периметра — сразу по всем секциям
+        widths = np.array([p.get("width_mm", 0.0) if p.get("kind") == "window" or p.get("kind") == "panel" else p.get("frame_width_mm", 0.0) for p in sections], dtype=np.float64)
+        heights = np.array([p.get("height_mm", 0.0) if p.get("kind") == "window" or p.get("kind") == "panel" else p.get("frame_height_mm", 0.0) for p in sections], dtype=np.float64)
+
+        invalid = np.flatnonzero((widths <= 0) | (heights <= 0))
+        if invalid.size:
+            idx = int(invalid[0])
+            p = sections[idx]
+            section_name = p.get('block_name', f"позиция №{idx + 1} ({p.get('kind').capitalize()})")
+            st.error(f"❌ Секция/позиция '{section_name}' имеет нулевую или отрицательную ширину ({float(widths[idx])} мм) или высоту ({float(heights[idx])} мм). Исправьте в разделе '{product_type}'.")
+            st.stop()
 
-        # --- Handles / Door Closer Counts ---
-        handles_count = 0
-        closer_count = 0
-        if product_type == "Дверь" or product_type == "Тамбур":
-            for s in sections:
-                if s.get("kind") == "door":
-                    handles_count += s.get("Nwin", 1)
-                    
-                    if door_closer.lower() == "есть":
-                        closer_count += s.get("Nwin", 1) 
-                        
-        # --- Final Calculation ---
-        final_calc_order_data = {
-            "product_type": product_type, "glass_type": glass_type, "toning": toning,
-            "assembly": assembly, "montage": montage, "handle_type": handle_type, "door_closer": door_closer
-        }
-        final_rows, total_sum, ensure_sum = fin_calc.calculate(
-            final_calc_order_data,
-            total_area_all=total_area_all, material_total=material_total,
-            lambr_cost=lambr_cost, handles_qty=handles_count, closer_qty=closer_count
+        areas = (widths * heights) / 1_000_000.0
+        perimeters = 2 * (widths + heights) / 1000.0
+        sections = [
+            {**p, "area_m2": float(area_m2), "perimeter_m": float(perimeter_m)}
+            for p, area_m2, perimeter_m in zip(sections, areas, perimeters)
+        ]
+            
+        # Множества дублей передаём отсортированными кортежами — так ключ кеша детерминирован
+        (gabarit_rows, total_area_gab, total_perimeter_gab, material_rows, material_total,
+         lambr_cost, final_rows, total_sum, ensure_sum) = _run_calculation(
+            excel, excel.data_version, sections,
+            {k: tuple(sorted(v)) for k, v in selected_duplicates.items()},
+            product_type, profile_system, glass_type, toning, assembly, montage, handle_type, door_closer,
         )
+        _write_result_sheets(excel, gabarit_rows, material_rows, final_rows, total_sum)
+        total_area_all = total_area_gab
         
         st.success(f"Расчёт выполнен. Итоговая сумма: {total_sum:.2f}")
 
@@ -1462,8 +1921,7 @@ def main():
             ])
             pos_index += 1
 
-        for row in rows_for_form:
-            excel.append_form_row(row)
+        excel.append_form_rows(rows_for_form)
         st.info("Данные сохранены в Google Sheets на листе 'ЗАПРОСЫ'.")
 
         # --- Вывод результатов и экспорт ---
@@ -1472,8 +1930,8 @@ def main():
         with tab1:
             st.subheader("Расчет по габаритам")
             if gabarit_rows:
-                gab_disp = [{"Тип элемента": t, "Фактическое значение": v} for t, v in gabarit_rows]
-                st.dataframe(gab_disp, use_container_width=True)
+                gab_df = pd.DataFrame(gabarit_rows, columns=["Тип элемента", "Фактическое значение"])
+                st.dataframe(gab_df, use_container_width=True)
             st.write(f"Общая площадь: **{total_area_gab:.3f} м²**")
             st.write(f"Суммарный периметр: **{total_perimeter_gab:.3f} м**")
             
@@ -1482,31 +1940,27 @@ def main():
             st.warning("⚠️ Проверьте, что формулы в СПРАВОЧНИК-1 используют корректные Python переменные (width, sash_w, n_sash и т.д.)")
             
             if material_rows:
-                mat_disp = []
-                for r in material_rows:
-                    mat_disp.append({
-                        "Тип изделия": r[0], "Система профиля": r[1], "Тип элемента": r[2], "Артикул": r[3],
-                        "Товар": r[4], "Ед.": r[5], "Цена за ед.": round(safe_float(r[6]), 2),
-                        "Ед. факт. расхода": r[7], "Кол-во факт. расхода": round(safe_float(r[8]), 3),
-                        "Норма к упаковке": r[9], "Ед. к отгрузке": r[10],
-                        "Кол-во к отгрузке": round(safe_float(r[11]), 3), "Сумма": round(safe_float(r[12]), 2),
-                    })
-                st.dataframe(mat_disp, use_container_width=True)
+                mat_df = pd.DataFrame(material_rows, columns=[
+                    "Тип изделия", "Система профиля", "Тип элемента", "Артикул",
+                    "Товар", "Ед.", "Цена за ед.",
+                    "Ед. факт. расхода", "Кол-во факт. расхода",
+                    "Норма к упаковке", "Ед. к отгрузке",
+                    "Кол-во к отгрузке", "Сумма",
+                ])
+                # Округление столбцами, а не по ячейке
+                for col, digits in (("Цена за ед.", 2), ("Кол-во факт. расхода", 3), ("Кол-во к отгрузке", 3), ("Сумма", 2)):
+                    mat_df[col] = pd.to_numeric(mat_df[col], errors="coerce").fillna(0.0).round(digits)
+                st.dataframe(mat_df, use_container_width=True)
             st.write(f"Итого по материалам (Профиль, Фурнитура): **{material_total:.2f}**")
             st.write(f"Панели (ламбри/сэндвич) — Итого: **{lambr_cost:.2f}**")
 
         with tab3:
             st.subheader("Итоговый расчет с монтажом")
             if final_rows:
-                fin_disp = []
-                for name, price, unit, total_val in final_rows:
-                    fin_disp.append({
-                        "Наименование услуг": name,
-                        "Стоимость за м²/шт": price if isinstance(price, str) else round(price, 2),
-                        "Ед": unit,
-                        "Итого": total_val if isinstance(total_val, str) else round(total_val, 2),
-                    })
-                st.dataframe(fin_disp, use_container_width=True)
+                fin_df = pd.DataFrame(final_rows, columns=["Наименование услуг", "Стоимость за м²/шт", "Ед", "Итого"])
+                for col in ("Стоимость за м²/шт", "Итого"):
+                    fin_df[col] = fin_df[col].map(lambda v: v if isinstance(v, str) else round(v, 2))
+                st.dataframe(fin_df, use_container_width=True)
             st.write(f"Обеспечение (65%): **{ensure_sum:.2f}**")
             st.write(f"ИТОГО к оплате: **{total_sum:.2f}**")
 
@@ -0,0 +1,49 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("gspread")
+pytest.importorskip("streamlit")
+
+import Axisapp_web as app  # noqa: E402
+
+
+class FakeWorksheet:
+    def __init__(self, rows):
+        self.rows = rows
+        self.fail_append = False
+
+    def get_all_values(self):
+        return [list(r) for r in self.rows]
+
+    def append_rows(self, rows, value_input_option=None):
+        if self.fail_append:
+            raise RuntimeError("API недоступен")
+        self.rows.extend(list(r) for r in rows)
+
+
+class FakeSpreadsheet:
+    def __init__(self, sheets):
+        self.sheets = {name: FakeWorksheet(rows) for name, rows in sheets.items()}
+
+    def worksheet(self, name):
+        if name not in self.sheets:
+            raise app.gspread.WorksheetNotFound(name)
+        return self.sheets[name]
+
+    def add_worksheet(self, name, rows=None, cols=None):
+        self.sheets[name] = FakeWorksheet([])
+        return self.sheets[name]
+
+
+@pytest.fixture
+def make_client(monkeypatch):
+    # Клиент с настоящим разбором листов поверх таблицы в памяти
+    def _make(sheets):
+        book = FakeSpreadsheet(sheets)
+        monkeypatch.setattr(app.GoogleSheetsClient, "_open_spreadsheet", lambda self, sheet_id: book)
+        return app.GoogleSheetsClient("test")
+    return _make
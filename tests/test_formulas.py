@@ -0,0 +1,31 @@
+import ast
+
+import numpy as np
+
+import Axisapp_web as app
+
+CTX = {"a": 3.0, "b": 5.0, "_x": 7.0, "qty": 1.0}
+
+
+def test_min_max_compiled_to_bytecode():
+    compiled = app.compile_formula("max(a, b) - min(a, b)")
+    assert not isinstance(compiled, ast.AST)
+    assert app.eval_compiled_formula(compiled, CTX) == 2.0
+
+
+def test_min_max_in_tree_walker():
+    # Имя с подчёркиванием не проходит в байткод — формулу считает _eval_ast.
+    # Раньше min/max здесь искались в globals() без встроенных функций, и формула давала 0
+    compiled = app.compile_formula("min(_x, b) + max(_x, a)")
+    assert isinstance(compiled, ast.AST)
+    assert app.eval_compiled_formula(compiled, CTX) == 12.0
+
+
+def test_min_max_vectorized_matches_scalar():
+    formula = "max(a, b) * qty + min(a, 4)"
+    arrays = {"a": np.array([3.0, 6.0]), "b": np.array([5.0, 1.0]), "qty": np.array([1.0, 2.0])}
+    expected = sum(
+        app.safe_eval_formula(formula, {"a": a, "b": b, "qty": q}) * q
+        for a, b, q in zip(arrays["a"], arrays["b"], arrays["qty"])
+    )
+    assert app.eval_formula_vectorized(formula, arrays) == expected
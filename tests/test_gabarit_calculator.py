@@ -0,0 +1,34 @@
+import Axisapp_web as app
+
+REF3 = [["Тип элемента", "Формула_Python"],
+        ["Площадь", "area * qty"],
+        ["Уплотнитель", "(2 * (sash_w + sash_h)) / 1000 * n_sash * qty"]]
+
+
+def _window(width, height, sash_w, sash_h, n_leaves, nwin):
+    return {
+        "kind": "window", "width_mm": width, "height_mm": height,
+        "left_mm": 0.0, "center_mm": 0.0, "right_mm": 0.0, "top_mm": 0.0,
+        "sash_width_mm": sash_w, "sash_height_mm": sash_h,
+        "n_leaves": n_leaves, "leaves": [{"width_mm": sash_w, "height_mm": sash_h}] * n_leaves,
+        "Nwin": nwin, "area_m2": width * height / 1e6, "perimeter_m": 2 * (width + height) / 1000.0,
+    }
+
+
+SECTIONS = [
+    _window(1000.0, 1400.0, 850.0, 1250.0, 2, 3),
+    _window(600.0, 700.0, 450.0, 550.0, 1, 2),
+    _window(1300.0, 600.0, 1150.0, 450.0, 2, 1),
+    _window(700.0, 300.0, 0.0, 0.0, 0, 7),
+]
+
+
+def test_vector_and_scalar_paths_give_identical_totals(make_client, monkeypatch):
+    excel = make_client({app.SHEET_REF3: REF3, app.SHEET_GABARITS: []})
+    vector = app.GabaritCalculator(excel).calculate({"product_type": "Окно"}, SECTIONS)
+
+    monkeypatch.setattr(app, "eval_formula_vectorized", lambda formula, arrays: None)
+    monkeypatch.setattr(app, "_stack_contexts", lambda contexts: None)
+    scalar = app.GabaritCalculator(excel).calculate({"product_type": "Окно"}, SECTIONS)
+
+    assert vector == scalar
@@ -0,0 +1,32 @@
+import Axisapp_web as app
+
+REF1_HEADER = ["Тип изделия:", "Система профиля", "Товар", "Тип элемента", "Артикул", "Ед.", "цена за ед ",
+               "Ед. фактического расхода", "кол-во норм к упаковке", " ед .норма к упаковке", "Формула_Python"]
+
+
+def _window(width, height, sash_w, sash_h, n_leaves, nwin):
+    return {
+        "kind": "window", "width_mm": width, "height_mm": height,
+        "left_mm": 0.0, "center_mm": 0.0, "right_mm": 0.0, "top_mm": 0.0,
+        "n_leaves": n_leaves, "leaves": [{"width_mm": sash_w, "height_mm": sash_h}] * n_leaves,
+        "Nwin": nwin, "area_m2": width * height / 1e6, "perimeter_m": 2 * (width + height) / 1000.0,
+    }
+
+
+def test_pack_count_ignores_float_noise_across_sections(make_client):
+    # Расход по секциям 75.60000000000001 + 8.0 + 6.4 = 90.00000000000001 — это 90 упаковок, не 91
+    ref1 = [REF1_HEADER, ["Окно", "ALG RUIT 73", "Упл 12-1 (CORNER)", "Уплотнитель (Средний)", "2-16-1201",
+                          "шт", "765", "шт", "1", "шт", "(2 * (sash_w + sash_h)) / 1000 * n_sash * qty"]]
+    excel = make_client({app.SHEET_REF1: ref1, app.SHEET_MATERIAL: []})
+    sections = [
+        _window(1000.0, 1400.0, 850.0, 1250.0, 2, 3),
+        _window(600.0, 700.0, 450.0, 550.0, 1, 2),
+        _window(1300.0, 600.0, 1150.0, 450.0, 2, 1),
+    ]
+
+    rows, total, _ = app.MaterialCalculator(excel).calculate(
+        {"product_type": "Окно", "profile_system": "ALG RUIT 73"}, sections, {})
+
+    assert len(rows) == 1
+    assert rows[0][11] == 90
+    assert total == 90 * 765.0
@@ -0,0 +1,32 @@
+import Axisapp_web as app
+
+REF2_HEADER = ["Тип заполнения панели", "Монтаж", "Ручка", "Тип стеклопакета"]
+
+
+def test_ref2_options_follow_reference_data_version(make_client):
+    app.load_ref2_options.clear()
+    old = make_client({app.SHEET_REF2: [REF2_HEADER, ["Ламбри без термо", "Есть", "Нажимная", "двойной"]]})
+    assert app.load_ref2_options(old, old.data_version)[0] == ["Ламбри без термо", "Стеклопакет"]
+
+    # Новый клиент — справочник перечитан; прежний результат из кеша не подходит
+    new = make_client({app.SHEET_REF2: [REF2_HEADER, ["Сэндвич", "Есть", "Нажимная", "тройной"]]})
+    assert new.data_version != old.data_version
+    options = app.load_ref2_options(new, new.data_version)
+    assert options[0] == ["Сэндвич", "Стеклопакет"]
+    assert options[4] == ["тройной"]
+    app.load_ref2_options.clear()
+
+
+REF1_HEADER = ["Тип изделия", "Система профиля", "Тип элемента", "Товар"]
+
+
+def test_ref1_groups_follow_reference_data_version(make_client):
+    app.load_ref1_groups.clear()
+    old = make_client({app.SHEET_REF1: [REF1_HEADER, ["Окно", "ALG", "Уплотнитель", "Упл 12-1"]]})
+    assert app.load_ref1_groups(old, old.data_version) == {("окно", "alg"): {"Уплотнитель": {"Упл 12-1"}}}
+
+    new = make_client({app.SHEET_REF1: [REF1_HEADER, ["Окно", "ALG", "Уплотнитель", "Упл 12-1"],
+                                        ["Окно", "", "Уплотнитель", "Упл 14-2"]]})
+    index = app.load_ref1_groups(new, new.data_version)
+    assert app.ref1_groups_for(index, "Окно", "ALG") == {"Уплотнитель": {"Упл 12-1", "Упл 14-2"}}
+    app.load_ref1_groups.clear()
@@ -0,0 +1,17 @@
+import math
+
+import Axisapp_web as app
+
+EDGE = ["nan", "NaN", "-inf", "Infinity", "1_000", "1e3", "٣", "\t5", "+5", "1.5.2", "1 234,50", "12,5",
+        "1\xa0000", "", " ", None, float("nan"), True, 3, 2.5, "—", "-", "abc", "1e400",
+        "0.1234567890123456789", "15434501.0226322412491", 12345678901234567891]
+
+
+def _same(a, b):
+    return a == b or (math.isnan(a) and math.isnan(b))
+
+
+def test_column_matches_safe_float():
+    column = app.safe_float_column(EDGE, 7.0)
+    for value, got in zip(EDGE, column):
+        assert _same(got, app.safe_float(value, 7.0)), value
@@ -0,0 +1,65 @@
+import threading
+import time
+
+import pytest
+
+import Axisapp_web as app
+from conftest import FakeSpreadsheet
+
+
+def test_form_header_survives_failed_append(make_client):
+    excel = make_client({})
+    ws = excel.ws(app.SHEET_FORM)  # листа нет — создаётся, заголовок ждёт первой записи
+
+    ws.fail_append = True
+    excel.append_form_rows([["1", 1]])
+    assert ws.rows == []
+
+    ws.fail_append = False
+    excel.append_form_rows([["2", 1]])
+    assert ws.rows == [app.FORM_HEADER, ["2", 1]]
+
+    excel.append_form_rows([["3", 1]])
+    assert ws.rows[-1] == ["3", 1]
+    assert ws.rows.count(app.FORM_HEADER) == 1
+
+
+def test_form_header_written_once_under_concurrent_appends(make_client):
+    excel = make_client({})
+    ws = excel.ws(app.SHEET_FORM)
+    append_rows = ws.append_rows
+
+    def slow_append(rows, value_input_option=None):
+        time.sleep(0.01)  # окно, в которое раньше успевала вторая сессия
+        append_rows(rows, value_input_option)
+    ws.append_rows = slow_append
+
+    threads = [threading.Thread(target=excel.append_form_rows, args=([[str(i), 1]],)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert ws.rows[0] == app.FORM_HEADER
+    assert ws.rows.count(app.FORM_HEADER) == 1
+    assert len(ws.rows) == 9
+
+
+def test_failed_connect_is_not_cached(monkeypatch):
+    book = FakeSpreadsheet({})
+    calls = []
+
+    def open_spreadsheet(self, sheet_id):
+        calls.append(sheet_id)
+        if len(calls) == 1:
+            raise RuntimeError("нет сети")
+        return book
+
+    monkeypatch.setattr(app.GoogleSheetsClient, "_open_spreadsheet", open_spreadsheet)
+    app._shared_sheets_client.clear()
+    try:
+        with pytest.raises(RuntimeError):
+            app._shared_sheets_client("retry")
+        assert app._shared_sheets_client("retry").wb is book
+    finally:
+        app._shared_sheets_client.clear()